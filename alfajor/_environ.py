@@ -0,0 +1,153 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Fast construction of WSGI environs for in-process requests."""
+
+from cStringIO import StringIO
+import sys
+from urllib import unquote
+from urlparse import urlsplit
+
+from werkzeug import (
+    MultiDict,
+    create_environ as werkzeug_create_environ,
+    url_encode,
+    url_fix,
+    )
+from werkzeug.urls import iri_to_uri
+
+from alfajor.utilities import LRUCache
+
+
+__all__ = ['EnvironTemplate', 'create_environ', 'environ_template']
+_empty_stream = StringIO('')
+_form_content_types = frozenset([
+    'application/x-www-form-urlencoded',
+    'multipart/form-data',
+    ])
+
+
+class EnvironTemplate(object):
+    """The part of a WSGI environ that is fixed for a base URL.
+
+    Building an environ with :func:`werkzeug.create_environ` sets up an
+    ``EnvironBuilder``, parses the base URL and assembles the server keys on
+    every call.  A template does that work once; :meth:`environ` then
+    shallow-copies it and fills in the per-request keys.  The result is the
+    same environ ``create_environ`` would build.
+
+    """
+
+    def __init__(self, base_url=None, multithread=False, multiprocess=False,
+                 run_once=False):
+        if base_url is None:
+            scheme, host, script_root = 'http', 'localhost', ''
+        else:
+            if isinstance(base_url, unicode):
+                base_url = iri_to_uri(base_url)
+            else:
+                base_url = url_fix(base_url)
+            scheme, host, script_root, query, fragment = urlsplit(base_url)
+            if query or fragment:
+                raise ValueError('base url must not contain a query string '
+                                 'or fragment')
+        pieces = host.split(':', 1)
+        if len(pieces) == 2 and pieces[1].isdigit():
+            port = pieces[1]
+        elif scheme == 'https':
+            port = '443'
+        else:
+            port = '80'
+        self.base_url = base_url
+        self.server_flags = (multithread, multiprocess, run_once)
+        self.template = {
+            'SCRIPT_NAME': unquote(script_root.rstrip('/')),
+            'SERVER_NAME': pieces[0],
+            'SERVER_PORT': port,
+            'HTTP_HOST': host,
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scheme,
+            'wsgi.multithread': multithread,
+            'wsgi.multiprocess': multiprocess,
+            'wsgi.run_once': run_once,
+            }
+
+    def environ(self, path='/', query_string=None, method='GET',
+                input_stream=None, content_type=None, content_length=None,
+                errors_stream=None):
+        """Return a new environ for a request to *path*.
+
+        Arguments are as for :func:`werkzeug.create_environ`.
+
+        """
+        if input_stream is None and content_type in _form_content_types:
+            # werkzeug encodes an empty form body for these
+            return werkzeug_create_environ(
+                path, self.base_url, query_string, method, input_stream,
+                content_type, content_length, errors_stream,
+                *self.server_flags)
+        if query_string is None and '?' in path:
+            path, query_string = path.split('?', 1)
+        if isinstance(path, unicode):
+            path = iri_to_uri(path).encode('utf-8')
+        if query_string is None:
+            query_string = ''
+        elif not isinstance(query_string, basestring):
+            if not isinstance(query_string, MultiDict):
+                query_string = MultiDict(query_string)
+            query_string = url_encode(query_string)
+
+        environ = self.template.copy()
+        environ['REQUEST_METHOD'] = method
+        environ['PATH_INFO'] = unquote(path)
+        environ['QUERY_STRING'] = query_string
+        environ['CONTENT_TYPE'] = content_type or ''
+        if content_type is not None:
+            environ['HTTP_CONTENT_TYPE'] = content_type
+        if content_length is not None:
+            environ['HTTP_CONTENT_LENGTH'] = str(content_length)
+        if input_stream is not None:
+            start = input_stream.tell()
+            input_stream.seek(0, 2)
+            content_length = input_stream.tell() - start
+            input_stream.seek(start)
+        else:
+            input_stream = _empty_stream
+        environ['CONTENT_LENGTH'] = str(content_length or '0')
+        environ['wsgi.input'] = input_stream
+        environ['wsgi.errors'] = errors_stream or sys.stderr
+        return environ
+
+    def __repr__(self):
+        return '<EnvironTemplate %r>' % self.base_url
+
+
+_templates = LRUCache(64)
+
+
+def environ_template(base_url=None, multithread=False, multiprocess=False,
+                     run_once=False):
+    """Return the shared :class:`EnvironTemplate` for these settings."""
+    key = (base_url, bool(multithread), bool(multiprocess), bool(run_once))
+    template = _templates.get(key)
+    if template is None:
+        template = EnvironTemplate(base_url, multithread, multiprocess,
+                                   run_once)
+        _templates[key] = template
+    return template
+
+
+def create_environ(path='/', base_url=None, query_string=None, method='GET',
+                   input_stream=None, content_type=None, content_length=None,
+                   errors_stream=None, multithread=False, multiprocess=False,
+                   run_once=False):
+    """A drop-in for :func:`werkzeug.create_environ` that reuses templates.
+    """
+    template = environ_template(base_url, multithread, multiprocess,
+                                run_once)
+    return template.environ(path, query_string, method, input_stream,
+                            content_type, content_length, errors_stream)
@@ -28,6 +28,7 @@ managers = {
         'webdriver': 'alfajor.browsers.managers:WebDriverManager',
         'wsgi': 'alfajor.browsers.managers:WSGIManager',
         'network': 'alfajor.browsers.managers:NetworkManager',
+        'replay': 'alfajor.browsers.managers:ReplayManager',
         'zero': 'alfajor.browsers.managers:ZeroManager',
         },
     'apiclient': {
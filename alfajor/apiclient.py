@@ -15,12 +15,15 @@ from urllib import urlencode
 from urlparse import urlparse, urlunparse
 from wsgiref.util import request_uri
 
+from blinker import signal
 import werkzeug
-from werkzeug import BaseResponse, Headers, create_environ, run_wsgi_app
+from werkzeug import BaseResponse, Headers, run_wsgi_app
 from werkzeug.test import _TestCookieJar, encode_multipart
 
+from alfajor.browsers._timings import Timings
 from alfajor.utilities import eval_dotted_path
 from alfajor._compat import json_loads as loads
+from alfajor._environ import create_environ
 
 
 logger = getLogger(__name__)
@@ -32,6 +35,8 @@ _json_content_types = set([
     'text/x-javascript',
     'text/x-json',
     ])
+after_api_request = signal('after_api_request')
+before_api_request = signal('before_api_request')
 
 
 class WSGIClientManager(object):
@@ -57,6 +62,9 @@ class WSGIClientManager(object):
 
 class APIClient(object):
 
+    last_timings = None
+    """The :class:`~alfajor.browsers._timings.Timings` of the last request."""
+
     def __init__(self, application, state=None, base_url=None):
         self.application = application
         self.state = state or _APIClientState(application)
@@ -67,6 +75,9 @@ class APIClient(object):
              content_length=0, errors_stream=None, multithread=False,
              multiprocess=False, run_once=False, environ_overrides=None,
              buffered=True):
+        self.last_timings = timings = Timings(method, path)
+        before_api_request.send(self)
+        timings.mark('signals')
 
         parsed = urlparse(path)
         if parsed.scheme:
@@ -96,11 +107,17 @@ class APIClient(object):
             environ.update(environ_overrides)
 
         logger.info("%s %s" % (method, request_uri(environ)))
+        timings.mark('environ')
         rv = run_wsgi_app(self.application, environ, buffered=buffered)
+        timings.mark('app')
 
         response = _APIClientResponse(*rv)
+        timings.mark('drain')
         response.state = new_state = current_state.copy()
         new_state.process_response(response, environ)
+        timings.mark('cookies')
+        after_api_request.send(self, response=response)
+        timings.mark('signals')
         return response
 
     def get(self, *args, **kw):
@@ -0,0 +1,238 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Element visibility from the styles of a page, without a browser engine.
+
+Only the properties that decide whether an element is shown, ``display``
+and ``visibility``, are computed.  Rules come from a small user agent
+stylesheet (covering the ``hidden`` attribute and elements never rendered),
+``<style>`` blocks, linked stylesheets and ``style`` attributes, and are
+cascaded by importance, origin, specificity and order.
+
+Selectors that depend on interaction (``:hover``, ``:focus``) or produce
+pseudo-elements never match, media queries with features never apply, and
+layout is not considered: an element sized to nothing or positioned
+off-screen is still visible.
+
+"""
+
+import re
+from urlparse import urljoin
+
+from cssselect import ExpressionError, HTMLTranslator, SelectorError, parse
+from lxml.etree import XPath
+
+from alfajor.utilities import LRUCache
+
+
+__all__ = ['ComputedStyles', 'parse_stylesheet']
+
+_properties = frozenset(['display', 'visibility'])
+_hidden_visibility = frozenset(['hidden', 'collapse'])
+_screen_media = frozenset(['all', 'screen'])
+
+_user_agent_stylesheet = """
+[hidden], area, base, basefont, datalist, head, link, meta, noembed,
+noframes, param, rp, script, style, template, title { display: none }
+input[type=hidden] { display: none }
+"""
+
+_comment_sub = re.compile(r'/\*.*?\*/', re.S).sub
+_translator = HTMLTranslator()
+_parsed = LRUCache(64)
+
+
+def parse_stylesheet(text):
+    """The rules of *text* that set ``display`` or ``visibility``.
+
+    Returns a list of (xpath, specificity, declarations) in stylesheet
+    order, one per selector, where declarations maps a property to a
+    (value, important) pair.  Results are cached by text, so a stylesheet
+    shared by many pages is parsed once.
+
+    """
+    rules = _parsed.get(text)
+    if rules is None:
+        rules = []
+        for prelude, body in _blocks(_comment_sub('', text)):
+            declarations = parse_declarations(body)
+            if not declarations:
+                continue
+            try:
+                selectors = parse(prelude)
+            except SelectorError:
+                continue
+            for selector in selectors:
+                if selector.pseudo_element is not None:
+                    continue
+                try:
+                    xpath = _translator.selector_to_xpath(selector)
+                except ExpressionError:
+                    # dynamic pseudo-classes such as :hover never match
+                    continue
+                rules.append((xpath, selector.specificity(), declarations))
+        _parsed[text] = rules
+    return rules
+
+
+def parse_declarations(text):
+    """Map ``display`` and ``visibility`` in *text* to (value, important)."""
+    declarations = {}
+    for declaration in text.split(';'):
+        name, sep, value = declaration.partition(':')
+        name = name.strip().lower()
+        if not sep or name not in _properties:
+            continue
+        value = value.strip().lower()
+        important = value.endswith('important')
+        if important:
+            value = value.rsplit('!', 1)[0].strip()
+        if value:
+            declarations[name] = (value, important)
+    return declarations
+
+
+def media_applies(media):
+    """True if a media query list applies to a screen of unknown size."""
+    if not media or not media.strip():
+        return True
+    for query in media.lower().split(','):
+        words = query.split()
+        if words and words[0] == 'only':
+            words = words[1:]
+        if len(words) == 1 and words[0] in _screen_media:
+            return True
+        if len(words) == 2 and words[0] == 'not' and \
+               words[1] not in _screen_media:
+            return True
+    return False
+
+
+def _blocks(text):
+    """Yield (prelude, body) for each style rule, entering @media blocks."""
+    position, length = 0, len(text)
+    while position < length:
+        start = text.find('{', position)
+        if start < 0:
+            return
+        statement_end = text.find(';', position, start)
+        if statement_end >= 0 and \
+               text[position:statement_end].lstrip().startswith('@'):
+            # @import, @charset and the like
+            position = statement_end + 1
+            continue
+        end = _block_end(text, start)
+        prelude = text[position:start].strip()
+        body = text[start + 1:end]
+        position = end + 1
+        if not prelude.startswith('@'):
+            yield prelude, body
+        elif prelude[1:6].lower() == 'media' and media_applies(prelude[6:]):
+            for rule in _blocks(body):
+                yield rule
+
+
+def _block_end(text, start):
+    """The index of the brace closing the block opened at *start*."""
+    depth = 0
+    for index in xrange(start, len(text)):
+        char = text[index]
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if not depth:
+                return index
+    return len(text)
+
+
+class ComputedStyles(object):
+    """The cascaded ``display`` and ``visibility`` of a document's elements.
+
+    :param root: the root element of the document.
+
+    :param fetch: optional, a callable returning the text of the stylesheet
+      at a URL, or None.  Linked stylesheets are skipped without it.
+
+    :param compile: optional, a callable compiling an XPath expression, such
+      as the ``xpath`` method of a selector cache.
+
+    """
+
+    def __init__(self, root, fetch=None, compile=None):
+        self.display = {}
+        self.visibility = {}
+        self._compile = compile or XPath
+        self._priorities = {}
+        self._order = 0
+        self._cascade(root, parse_stylesheet(_user_agent_stylesheet), 0)
+        for text in _author_stylesheets(root, fetch):
+            self._cascade(root, parse_stylesheet(text), 1)
+        for element in root.xpath('descendant-or-self::*[@style]'):
+            self._order += 1
+            self._apply(element, parse_declarations(element.get('style')),
+                        (1, 1, (0, 0, 0), self._order))
+        del self._priorities
+
+    def is_visible(self, element):
+        """True unless *element* or an ancestor has ``display: none``, or
+        its inherited ``visibility`` hides it."""
+        display, visibility = self.display, self.visibility
+        inherited = None
+        while element is not None:
+            if display.get(element) == 'none':
+                return False
+            if inherited is None:
+                inherited = visibility.get(element)
+            element = element.getparent()
+        return inherited not in _hidden_visibility
+
+    def _cascade(self, root, rules, origin):
+        for xpath, specificity, declarations in rules:
+            self._order += 1
+            priority = (origin, 0, specificity, self._order)
+            for element in self._compile(xpath)(root):
+                self._apply(element, declarations, priority)
+
+    def _apply(self, element, declarations, priority):
+        priorities = self._priorities
+        for name, (value, important) in declarations.iteritems():
+            if value == 'inherit':
+                continue
+            if name == 'visibility' and value == 'initial':
+                value = 'visible'
+            key = (name, element)
+            rank = (important,) + priority
+            if key in priorities and priorities[key] > rank:
+                continue
+            priorities[key] = rank
+            getattr(self, name)[element] = value
+
+
+def _author_stylesheets(root, fetch):
+    """The texts of the page's stylesheets, in document order."""
+    base = None
+    for element in root.iter('base'):
+        base = element.get('href')
+        break
+    for element in root.iter('style', 'link'):
+        if not media_applies(element.get('media')):
+            continue
+        if element.tag == 'style':
+            if element.text:
+                yield element.text
+            continue
+        rel = (element.get('rel') or '').lower().split()
+        href = element.get('href')
+        if 'stylesheet' not in rel or 'alternate' in rel or not href or \
+               fetch is None:
+            continue
+        if base:
+            href = urljoin(base, href)
+        text = fetch(href)
+        if text:
+            yield text
+
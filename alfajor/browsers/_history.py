@@ -0,0 +1,196 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Back and forward history for browsers that fetch pages themselves."""
+
+import zlib
+
+from alfajor.utilities import LRUCache
+
+
+__all__ = ['History', 'HistoryEntry']
+
+
+class History(object):
+    """The pages a browser has visited, and its place among them.
+
+    Pages other than the current one are held as compressed bodies, which
+    count against *max_bytes*; the pages furthest from the current one are
+    forgotten to stay within it.  The parsed documents of up to
+    *max_documents* recently left pages are kept too, so going back to them
+    restores the tree as it was left, filled forms and all.  Other pages are
+    parsed again from their bodies when the browser's document is next used.
+
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024, max_documents=4):
+        self.max_bytes = max_bytes
+        self.entries = []
+        self.index = -1
+        self._documents = LRUCache(max_documents)
+
+    @property
+    def current(self):
+        """The :class:`HistoryEntry` of the current page, or None."""
+        if self.index < 0:
+            return None
+        return self.entries[self.index]
+
+    @property
+    def can_go_back(self):
+        return self.index > 0
+
+    @property
+    def can_go_forward(self):
+        return self.index < len(self.entries) - 1
+
+    def visit(self, entry, document=None):
+        """Make *entry* the current page, discarding any forward pages.
+
+        :param document: the parsed document of the page being left, if any.
+
+        """
+        self._leave(document)
+        for forward in self.entries[self.index + 1:]:
+            self._documents.pop(forward)
+        del self.entries[self.index + 1:]
+        self.entries.append(entry)
+        self.index = len(self.entries) - 1
+        self._trim()
+
+    def back(self, document=None):
+        """Step back a page, returning its entry, or None at the start."""
+        if not self.can_go_back:
+            return None
+        return self._go(-1, document)
+
+    def forward(self, document=None):
+        """Step forward a page, returning its entry, or None at the end."""
+        if not self.can_go_forward:
+            return None
+        return self._go(1, document)
+
+    def document(self, entry):
+        """Take the kept document of *entry*, or None if it was not kept."""
+        return self._documents.pop(entry)
+
+    def copy(self):
+        """A history with the same pages and no kept documents.
+
+        Left pages are shared; the current page gets an entry of its own,
+        so it is not compressed until the copy leaves it.
+
+        """
+        other = type(self)(self.max_bytes, self._documents.maxsize)
+        other.entries = list(self.entries)
+        other.index = self.index
+        if self.index >= 0:
+            other.entries[self.index] = self.entries[self.index].copy()
+        return other
+
+    def clear(self):
+        self.entries = []
+        self.index = -1
+        self._documents.clear()
+
+    @property
+    def size(self):
+        """Bytes held by the compressed bodies of left pages."""
+        return sum(entry.size for entry in self.entries)
+
+    def _go(self, step, document):
+        self._leave(document)
+        self.index += step
+        self._trim()
+        return self.entries[self.index]
+
+    def _leave(self, document):
+        current = self.current
+        if current is None:
+            return
+        current.pack()
+        if document is not None and self._documents.maxsize:
+            self._documents[current] = document
+
+    def _trim(self):
+        """Forget the pages furthest from the current one while over budget.
+        """
+        entries = self.entries
+        size = self.size
+        while size > self.max_bytes and len(entries) > 1:
+            if self.index >= len(entries) - 1 - self.index:
+                dropped = entries.pop(0)
+                self.index -= 1
+            else:
+                dropped = entries.pop()
+            self._documents.pop(dropped)
+            size -= dropped.size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __repr__(self):
+        return '<%s %s/%s bytes=%s>' % (
+            type(self).__name__, self.index + 1, len(self.entries), self.size)
+
+
+class HistoryEntry(object):
+    """A visited page: its location, response and request state.
+
+    The body is held as given while the page is current, and compressed by
+    :meth:`pack` when it is left.  *body* may be a string or any object
+    with a ``chunks()`` method yielding strings.
+
+    """
+
+    def __init__(self, url, body, **state):
+        self.url = url
+        self.state = state
+        self._body = body
+        self._packed = None
+
+    @property
+    def body(self):
+        """The response body as a string."""
+        if self._packed is None:
+            body = self._body
+            if body is None or isinstance(body, basestring):
+                return body
+            return ''.join(body.chunks())
+        return zlib.decompress(self._packed)
+
+    @property
+    def size(self):
+        """Bytes held for the body, once packed; 0 before."""
+        return self._packed is not None and len(self._packed) or 0
+
+    def pack(self):
+        """Compress the body, releasing the original."""
+        body = self._body
+        if self._packed is not None or body is None:
+            return
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if isinstance(body, str):
+            self._packed = zlib.compress(body)
+        else:
+            compressor = zlib.compressobj()
+            packed = [compressor.compress(chunk) for chunk in body.chunks()]
+            packed.append(compressor.flush())
+            self._packed = ''.join(packed)
+        self._body = None
+
+    def copy(self):
+        """An entry for the same page, sharing its body."""
+        other = type(self)(self.url, self._body, **self.state)
+        other._packed = self._packed
+        return other
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.url)
@@ -0,0 +1,210 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""A private HTTP cache for browsers that fetch pages themselves."""
+
+from cookielib import http2time
+from time import time
+
+from alfajor.browsers._lxml import DocumentCache
+from alfajor.utilities import LRUCache
+
+
+__all__ = ['HTTPCache']
+
+_cacheable_methods = frozenset(['GET', 'HEAD'])
+_cacheable_status_codes = frozenset([200, 203])
+# headers of a 304 that must not replace the stored ones
+_unrevalidated_headers = frozenset(['content-length', 'content-type',
+                                    'content-encoding', 'transfer-encoding'])
+
+
+class HTTPCache(object):
+    """Stores responses and their validators for one browser.
+
+    Responses to GET requests are stored if their ``Cache-Control`` and
+    ``Expires`` headers allow it and they are either fresh for some time or
+    carry an ``ETag`` or ``Last-Modified`` validator.  A fresh response is
+    served again without contacting the application; a stale one is
+    revalidated with ``If-None-Match`` and ``If-Modified-Since``, and served
+    from the cache if the application answers 304 Not Modified.
+
+    Parsed documents of cached pages are kept in :attr:`documents`, so a
+    page served from the cache is not parsed again.
+
+    """
+
+    def __init__(self, maxsize=256):
+        self._entries = LRUCache(maxsize)
+        self.documents = DocumentCache()
+        self.hits = self.revalidations = 0
+
+    def lookup(self, method, url, request_header):
+        """The entry for a request, or None.
+
+        :param request_header: a callable returning the value of a request
+          header by name, or None.
+
+        """
+        if method not in _cacheable_methods:
+            # unsafe methods invalidate what is cached for the URL
+            self._entries.pop(url)
+            return None
+        if method != 'GET':
+            return None
+        entry = self._entries.get(url)
+        if entry is None or not entry.matches(request_header):
+            return None
+        return entry
+
+    def store(self, method, url, status, headers, body, request_header,
+              now=None):
+        """Store a response if it is cacheable.  Returns the entry or None.
+
+        :param headers: the response headers as a list of (name, value).
+
+        """
+        if method != 'GET' or \
+               int(status.split(None, 1)[0]) not in _cacheable_status_codes:
+            return None
+        entry = _CacheEntry(status, headers, body, now or time())
+        if not entry.storable:
+            return None
+        vary = _header(headers, 'Vary')
+        if vary:
+            names = [name.strip().lower() for name in vary.split(',')]
+            if '*' in names:
+                return None
+            entry.vary = dict((name, request_header(name)) for name in names)
+        self._entries[url] = entry
+        return entry
+
+    def hit(self, entry):
+        """Count a response served from *entry* without revalidation."""
+        self.hits += 1
+
+    def revalidated(self, entry, headers, now=None):
+        """Refresh *entry* from the headers of a 304 response.
+
+        Returns the headers to present for the response: the stored headers,
+        updated from the 304.
+
+        """
+        self.revalidations += 1
+        entry.update(headers, now or time())
+        updated = entry.headers + [
+            (name, value) for name, value in headers
+            if name.lower() == 'set-cookie']
+        return updated
+
+    def clear(self):
+        """Discard all stored responses and documents."""
+        self._entries.clear()
+        self.documents.clear()
+        self.hits = self.revalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<%s %s/%s hits=%s revalidations=%s>' % (
+            type(self).__name__, len(self._entries), self._entries.maxsize,
+            self.hits, self.revalidations)
+
+
+class _CacheEntry(object):
+
+    vary = None
+
+    def __init__(self, status, headers, body, now):
+        self.status = status
+        self.body = body
+        # cookies belong to the response that set them, not to the cache
+        self.headers = [(name, value) for name, value in headers
+                        if name.lower() != 'set-cookie']
+        self._refresh(now)
+
+    def update(self, headers, now):
+        """Merge the headers of a 304 response."""
+        replaced = set(name.lower() for name, value in headers) - \
+                   _unrevalidated_headers
+        replaced.add('set-cookie')
+        self.headers = [(name, value) for name, value in self.headers
+                        if name.lower() not in replaced]
+        self.headers.extend((name, value) for name, value in headers
+                            if name.lower() in replaced and
+                            name.lower() != 'set-cookie')
+        self._refresh(now)
+
+    def _refresh(self, now):
+        """Recompute freshness and validators from the stored headers."""
+        directives = _cache_control(_header(self.headers, 'Cache-Control'))
+        self.etag = _header(self.headers, 'ETag')
+        self.last_modified = _header(self.headers, 'Last-Modified')
+        self.storable = 'no-store' not in directives
+
+        lifetime = 0
+        if 'no-cache' in directives:
+            lifetime = 0
+        elif 'max-age' in directives:
+            try:
+                lifetime = int(directives['max-age'])
+            except (TypeError, ValueError):
+                lifetime = 0
+        elif _header(self.headers, 'Expires'):
+            expires = http2time(_header(self.headers, 'Expires'))
+            date = http2time(_header(self.headers, 'Date') or '') or now
+            lifetime = expires is not None and expires - date or 0
+        try:
+            age = int(_header(self.headers, 'Age') or 0)
+        except ValueError:
+            age = 0
+        self.expires = now + lifetime - age
+        if lifetime <= 0 and not (self.etag or self.last_modified):
+            self.storable = False
+
+    def is_fresh(self, now=None):
+        return (now or time()) < self.expires
+
+    def matches(self, request_header):
+        """True if a request has the headers this response varied on."""
+        if not self.vary:
+            return True
+        for name, value in self.vary.iteritems():
+            if request_header(name) != value:
+                return False
+        return True
+
+    def conditional_headers(self):
+        """(name, value) pairs that make a request conditional."""
+        headers = []
+        if self.etag:
+            headers.append(('If-None-Match', self.etag))
+        if self.last_modified:
+            headers.append(('If-Modified-Since', self.last_modified))
+        return headers
+
+
+def _header(headers, name):
+    """The first value of *name* in a list of headers, or None."""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _cache_control(value):
+    """A mapping of Cache-Control directives to their values (or None)."""
+    directives = {}
+    if not value:
+        return directives
+    for directive in value.split(','):
+        name, sep, argument = directive.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = sep and argument.strip().strip('"') or None
+    return directives
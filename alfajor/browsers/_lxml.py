@@ -6,13 +6,20 @@
 
 
 """Low level LXML element implementation & parser wrangling."""
-from collections import defaultdict
+from copy import deepcopy
+from hashlib import sha1
+from itertools import count
 import mimetypes
 import re
+import threading
 from UserDict import DictMixin
+from urlparse import urljoin
 from textwrap import fill
+from time import time
+import weakref
 
 from lxml import html as lxml_html
+from lxml.cssselect import CSSSelector
 from lxml.etree import ElementTree, XPath
 from lxml.html import (
     fromstring as html_from_string,
@@ -20,11 +27,16 @@ from lxml.html import (
     )
 from lxml.html._setmixin import SetMixin
 
+from alfajor.browsers._css import ComputedStyles
+from alfajor.browsers._stream import stream_query as _stream_query
+from alfajor.browsers._timings import TimingHistory
 from alfajor._compat import property
-from alfajor.utilities import lazy_property, to_pairs
+from alfajor.utilities import LRUCache, lazy_property, to_pairs
 
 
-__all__ = ['html_parser_for', 'html_from_string']
+__all__ = ['DocumentCache', 'SelectorCache', 'html_parser_for',
+           'html_from_string', 'shared_document_cache',
+           'shared_selector_cache']
 _single_id_selector = re.compile(r'#[A-Za-z][A-Za-z0-9:_.\-]*$')
 XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
 
@@ -48,6 +60,165 @@ def _nons(tag):
 _enclosing_form_xpath = XPath('ancestor::form[1]')
 
 
+_field_tags = frozenset(['input', 'select', 'textarea'])
+_whitespace_sub = re.compile(r'\s+', re.UNICODE).sub
+
+
+class _DocumentState(object):
+    """Indexes and a change counter for one parsed document.
+
+    The state is kept on the root element, which the browser holds for as
+    long as it shows the document; a new document (after
+    :meth:`DOMMixin.sync_document`, say) starts with a new state.  Indexes
+    are built on first use.
+
+    :attr:`generation` counts changes made through the element APIs, such
+    as setting a field's value.  Each change discards cached text, query
+    and containment results; changes to ids, names or the shape of the
+    tree drop the indexes too.
+
+    """
+
+    _browser = None
+
+    def __init__(self):
+        self.generation = 0
+        self._ids = None
+        self._fields = {}
+        self._options = {}
+        self._texts = {}
+        self._contains = {}
+        self._memo = {}
+
+    @property
+    def browser(self):
+        """The browser showing the document, if bound and still alive."""
+        return self._browser and self._browser()
+
+    def bind(self, browser):
+        """Make *browser* the browser of the document's elements."""
+        self._browser = weakref.ref(browser)
+
+    def changed(self, structure=False):
+        """Note a change to the document."""
+        self.generation += 1
+        self._texts = {}
+        self._contains = {}
+        self._memo = {}
+        if structure:
+            self._ids = None
+            self._fields = {}
+            self._options = {}
+
+    def memoized(self, key, compute, *args):
+        """The result of *compute(\*args)*, remembered under *key* until the
+        document changes."""
+        try:
+            return self._memo[key]
+        except KeyError:
+            result = self._memo[key] = compute(*args)
+            return result
+
+    def text(self, element):
+        """The whitespace-normalized text content of *element*."""
+        text = self._texts.get(element)
+        if text is None:
+            text = callable_unicode(
+                u' '.join(_collect_string_content(element).split()))
+            self._texts[element] = text
+        return text
+
+    def contains(self, root, needle):
+        """True if the text of *root* contains *needle*, ignoring
+        differences in whitespace."""
+        key = (root, needle)
+        found = self._contains.get(key)
+        if found is None:
+            found = _whitespace_sub(u' ', needle) in self.text(root)
+            self._contains[key] = found
+        return found
+
+    def elements_by_id(self, root):
+        """A mapping of id to the elements with that id, in document
+        order."""
+        ids = self._ids
+        if ids is None:
+            ids = {}
+            for el in root.iter():
+                id = el.get('id')
+                if id is not None:
+                    ids.setdefault(id, []).append(el)
+            self._ids = ids
+        return ids
+
+    def form_fields(self, form):
+        """(names in document order, mapping of name to field elements) for
+        the input, select and textarea elements in *form*."""
+        fields = self._fields.get(form)
+        if fields is None:
+            names, by_name = [], {}
+            for el in form.iterdescendants():
+                if not isinstance(el.tag, basestring) or \
+                       _nons(el.tag) not in _field_tags:
+                    continue
+                name = el.get('name')
+                if name is None:
+                    continue
+                if name not in by_name:
+                    names.append(name)
+                    by_name[name] = []
+                by_name[name].append(el)
+            self._fields[form] = fields = (names, by_name)
+        return fields
+
+    def options_by_value(self, select):
+        """A mapping of value to the <option> elements of *select* having
+        it, in document order."""
+        options = self._options.get(select)
+        if options is None:
+            options = {}
+            for option in _options_xpath(select):
+                options.setdefault(_value_from_option(option), []).append(
+                    option)
+            self._options[select] = options
+        return options
+
+
+def _document_state(element):
+    """The :class:`_DocumentState` of the document containing *element*."""
+    root = element.getroottree().getroot()
+    state = root.__dict__.get('_document_state')
+    if state is None:
+        state = root.__dict__['_document_state'] = _DocumentState()
+    return state
+
+
+def _bind_document(document, browser):
+    """Make *browser* the browser of the elements of *document*."""
+    if document is not None:
+        _document_state(document).bind(browser)
+
+
+def _element_browser(element):
+    """The browser of the document containing *element*, or None.
+
+    Documents are bound to a browser when it installs them.  Failing that,
+    elements fall back to the browser whose parser built the document.
+
+    """
+    tree = element.getroottree()
+    state = tree.getroot().__dict__.get('_document_state')
+    if state is not None and state._browser is not None:
+        return state.browser
+    browser = getattr(tree.parser, 'browser', None)
+    return browser and browser()
+
+
+def _changed(element, structure=False):
+    """Note a change made to *element* through the element APIs."""
+    _document_state(element).changed(structure)
+
+
 class callable_unicode(unicode):
     """Compatibility class for 'element.text_content'"""
 
@@ -58,10 +229,123 @@ class callable_unicode(unicode):
 def html_parser_for(browser, element_mixins):
     "Return an HTMLParser linked to *browser* and powered by *element_mixins*."
     parser = lxml_html.HTMLParser()
-    parser.set_element_class_lookup(ElementLookup(browser, element_mixins))
+    lookup = element_lookup(element_mixins)
+    parser.set_element_class_lookup(lookup)
+    # parsers sharing a cache key produce interchangeable trees
+    parser.cache_key = lookup.cache_key
+    # a weak reference: every document keeps its parser alive
+    parser.browser = browser is not None and weakref.ref(browser) or None
     return parser
 
 
+class DocumentCache(object):
+    """A bounded, content-addressed cache of parsed documents.
+
+    Documents are keyed by a digest of the markup and the element classes of
+    the parser that built them.  A cache hit returns a private deep copy of
+    the cached tree, which costs far less than parsing the markup again.
+
+    """
+
+    def __init__(self, maxsize=64):
+        self._trees = LRUCache(maxsize)
+
+    @property
+    def hits(self):
+        """The number of documents served from the cache."""
+        return self._trees.hits
+
+    @property
+    def misses(self):
+        """The number of documents that had to be parsed."""
+        return self._trees.misses
+
+    def parse(self, markup, parser):
+        """Return a document for *markup* as parsed by *parser*."""
+        if isinstance(markup, unicode):
+            digest = sha1(markup.encode('utf-8')).digest()
+        else:
+            digest = sha1(markup).digest()
+        key = (type(markup), digest, parser.cache_key)
+        tree = self._trees.get(key)
+        if tree is not None:
+            return deepcopy(tree)
+        document = html_from_string(markup, parser=parser)
+        self._trees[key] = deepcopy(document)
+        return document
+
+    def clear(self):
+        """Discard all cached documents and reset the counters."""
+        self._trees.clear()
+
+    def __repr__(self):
+        return '<%s %s/%s hits=%s misses=%s>' % (
+            type(self).__name__, len(self._trees), self._trees.maxsize,
+            self.hits, self.misses)
+
+
+shared_document_cache = DocumentCache()
+"""A :class:`DocumentCache` for use by any number of browsers."""
+
+
+class SelectorCache(object):
+    """A bounded cache of compiled CSS selectors and XPath expressions.
+
+    Translating CSS to XPath and compiling the result costs far more than
+    evaluating it against a typical page.  Compiled queries are keyed by
+    their source and shared by every element and thread.
+
+    """
+
+    def __init__(self, maxsize=512):
+        self._compiled = LRUCache(maxsize)
+
+    @property
+    def hits(self):
+        """The number of queries served precompiled."""
+        return self._compiled.hits
+
+    @property
+    def misses(self):
+        """The number of queries that had to be compiled."""
+        return self._compiled.misses
+
+    def css(self, expr, translator='html'):
+        """Return a compiled :class:`CSSSelector` for *expr*."""
+        key = ('css', expr, translator)
+        selector = self._compiled.get(key)
+        if selector is None:
+            selector = CSSSelector(expr, translator=translator)
+            self._compiled[key] = selector
+        return selector
+
+    def xpath(self, expr, namespaces=None):
+        """Return a compiled :class:`XPath` for *expr*."""
+        key = ('xpath', expr,
+               namespaces and tuple(sorted(namespaces.items())) or None)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = XPath(expr, namespaces=namespaces)
+            self._compiled[key] = compiled
+        return compiled
+
+    def clear(self):
+        """Discard all compiled queries and reset the counters."""
+        self._compiled.clear()
+
+    def __len__(self):
+        return len(self._compiled)
+
+    def __repr__(self):
+        return '<%s %s/%s hits=%s misses=%s>' % (
+            type(self).__name__, len(self._compiled), self._compiled.maxsize,
+            self.hits, self.misses)
+
+
+shared_selector_cache = SelectorCache()
+"""The :class:`SelectorCache` used by element queries."""
+
+
 class DOMMixin(object):
     """Supplies DOM parsing and query methods to browsers.
 
@@ -76,29 +360,105 @@ class DOMMixin(object):
 
     """
 
+    document_cache = None
+    """An optional :class:`DocumentCache` consulted when parsing responses."""
+
+    last_timings = None
+    """The :class:`~alfajor.browsers._timings.Timings` of the last request."""
+
+    _page_document_cache = None
+    # A DocumentCache for the current page only, when it is likely to be
+    # seen again (for example, it is held in an HTTP cache).
+
+    @lazy_property
+    def timing_history(self):
+        """A rolling :class:`~alfajor.browsers._timings.TimingHistory`."""
+        return TimingHistory()
+
     @lazy_property
     def document(self):
         """An LXML tree of the :attr:`response` content."""
         # TODO: document decision to use 'fromstring' (means dom may
         # be what the remote sent, may not.)
-        if self.response is None:
+        response = self.response
+        if response is None:
             return None
-        return html_from_string(self.response, parser=self._lxml_parser)
+        parse_started = time()
+        cache = self.document_cache or self._page_document_cache
+        if cache is not None:
+            document = cache.parse(response, self._lxml_parser)
+        else:
+            document = html_from_string(response, parser=self._lxml_parser)
+        _bind_document(document, self)
+        if self.last_timings is not None:
+            self.last_timings.record('parse', time() - parse_started)
+        return document
 
     def sync_document(self):
         """Synchronize the :attr:`document` DOM with the visible page."""
-        self.__dict__.pop('document', None)
+        document = self.__dict__.pop('document', None)
+        if document is not None:
+            # elements still held from the old document query it afresh
+            _changed(document, structure=True)
 
     def __contains__(self, needle):
-        """True if *needle* exists anywhere in the response content."""
-        # TODO: make this normalize whitespace?  something like split
-        # *needle* on whitespace, build a regex of r'\s+'-separated
-        # bits.  this could be a fallback to a simple containment
-        # test.
+        """True if *needle* exists anywhere in the response content.
+
+        Whitespace is normalized in the page text, so any run of whitespace
+        in *needle* matches any run in the page.  Results are remembered
+        until the document changes.
+
+        """
         document = self.document
         if document is None:
             return False
-        return needle in document.text_content
+        return _document_state(document).contains(document, needle)
+
+    def stream_query(self, selectors):
+        """Yield (selector, element) pairs matching *selectors* in the page.
+
+        The response is read in chunks and never parsed into a
+        :attr:`document`, so memory use is bounded by the largest match
+        rather than the page.  Only type, class, id and attribute selectors
+        and the descendant and child combinators are supported; see
+        :func:`~alfajor.browsers._stream.stream_query`.
+
+        """
+        if not self._has_response():
+            return iter(())
+        return _stream_query(self._response_chunks(), selectors,
+                             self._lxml_parser)
+
+    def _has_response(self):
+        """True if there is a :attr:`response` to read."""
+        return self.response is not None
+
+    def _response_chunks(self, size=65536):
+        """The :attr:`response` in strings of at most *size* bytes."""
+        response = self.response
+        for offset in xrange(0, len(response), size):
+            yield response[offset:offset + size]
+
+    def _fetch_resource(self, url):
+        """The body of the subresource at *url*, or None.
+
+        Browsers that can fetch a resource without leaving the page, such
+        as a linked stylesheet, override this.
+
+        """
+        return None
+
+    @lazy_property
+    def _stylesheets(self):
+        return LRUCache(32)
+
+    def _stylesheet(self, url):
+        """The text of the stylesheet at *url*, fetched once per browser."""
+        url = urljoin(getattr(self, 'location', None) or '', url)
+        text = self._stylesheets.get(url)
+        if text is None:
+            text = self._stylesheets[url] = self._fetch_resource(url) or ''
+        return text
 
     @property
     def xpath(self):
@@ -122,7 +482,78 @@ class DOMElement(object):
     @property
     def forms(self):
         """Return a list of all the forms."""
-        return _FormsList(_forms_xpath(self))
+        return _FormsList(_document_state(self).memoized(
+            ('forms', self), _forms_xpath, self))
+
+    def get_element_by_id(self, id, *default):
+        """Return the first element at or beneath this one with *id*.
+
+        Raises KeyError, or returns *default* if given, when there is none.
+        Ids are looked up in an index of the document.
+
+        """
+        root = self.getroottree().getroot()
+        for el in _document_state(root).elements_by_id(root).get(id, ()):
+            if self is root or el is self or \
+                   any(ancestor is self for ancestor in el.iterancestors()):
+                return el
+        if default:
+            return default[0]
+        raise KeyError(id)
+
+    def cssselect(self, expr, translator='html'):
+        """Return elements beneath this one matching CSS selector *expr*.
+
+        Selectors are compiled once, in :data:`shared_selector_cache`, and
+        results are remembered until the document changes.
+
+        """
+        return list(_document_state(self).memoized(
+            ('css', self, expr, translator), _css_query, self, expr,
+            translator))
+
+    def xpath(self, _path, namespaces=None, extensions=None,
+              smart_strings=True, **_variables):
+        """Evaluate XPath *_path* with this element as the context node.
+
+        Expressions are compiled once, in :data:`shared_selector_cache`, and
+        results are remembered until the document changes.
+
+        """
+        if extensions is not None or not smart_strings:
+            return super(DOMElement, self).xpath(
+                _path, namespaces=namespaces, extensions=extensions,
+                smart_strings=smart_strings, **_variables)
+        key = ('xpath', self, _path,
+               namespaces and tuple(sorted(namespaces.items())) or None,
+               tuple(sorted(_variables.items())))
+        try:
+            hash(key)
+        except TypeError:
+            # unhashable variables: evaluate without remembering
+            return _xpath_query(self, _path, namespaces, _variables)
+        result = _document_state(self).memoized(
+            key, _xpath_query, self, _path, namespaces, _variables)
+        if isinstance(result, list):
+            return list(result)
+        return result
+
+    def mark_changed(self, structure=True):
+        """Note a change made to the document directly through lxml.
+
+        Changes made through the element APIs, such as setting a field's
+        value, are noted automatically.  Raw lxml changes are not: after
+        ``append()``, ``remove()``, assigning ``.text`` or ``.tail``, or
+        ``set()`` on any element, the memoized results of
+        :meth:`cssselect`, :meth:`xpath`, :meth:`get_element_by_id`,
+        ``form_values`` and text containment stay stale until this method
+        is called on an element of the document.
+
+        :param structure: False if only text or attributes changed, which
+          keeps the id and form field indexes.
+
+        """
+        _changed(self, structure)
 
     # DOM methods (Mostly applicable only with javascript enabled.)  Capable
     # browsers should re-implement these methods.
@@ -145,14 +576,22 @@ class DOMElement(object):
     def fire_event(self, name, wait_for=None, timeout=0):
         """Fire DOM event *name* on this element."""
 
-    # TODO:jek: investigate css-tools for implementing this for the WSGI
-    # browser
-    is_visible = True
-    """True if the element is visible.
+    @property
+    def is_visible(self):
+        """True if the element is visible.
 
-    Note: currently always True in the WSGI browser.
+        Computed from the page's ``hidden`` attributes, ``<style>`` blocks,
+        linked stylesheets (if the browser can fetch them) and ``style``
+        attributes: the element is hidden by ``display: none`` on it or an
+        ancestor, or by an inherited ``visibility: hidden``.  Styles are
+        computed once per document generation.  See
+        :mod:`alfajor.browsers._css` for what is not considered.
 
-    """
+        """
+        root = self.getroottree().getroot()
+        styles = _document_state(root).memoized(
+            ('computed_styles', root), _computed_styles, root)
+        return styles.is_visible(self)
 
     @property
     def text_content(self):
@@ -163,9 +602,11 @@ class DOMElement(object):
         attribute or as a method call and normalizes all whitespace
         as single spaces.
 
+        The text is cached until the document changes through the element
+        APIs.
+
         """
-        text = u' '.join(_collect_string_content(self).split())
-        return callable_unicode(text)
+        return _document_state(self).text(self)
 
     @property
     def innerHTML(self):
@@ -234,6 +675,20 @@ class DOMElement(object):
         return fill(html, 79, subsequent_indent='    ')
 
 
+def _computed_styles(root):
+    browser = _element_browser(root)
+    return ComputedStyles(root, getattr(browser, '_stylesheet', None),
+                          shared_selector_cache.xpath)
+
+
+def _css_query(element, expr, translator):
+    return shared_selector_cache.css(expr, translator)(element)
+
+
+def _xpath_query(element, path, namespaces, variables):
+    return shared_selector_cache.xpath(path, namespaces)(element, **variables)
+
+
 class FormElement(object):
 
     @property
@@ -281,7 +736,16 @@ class FormElement(object):
             fields[name] = value
 
     def form_values(self):
-        """Return name, value pairs of form data as a browser would submit."""
+        """Return name, value pairs of form data as a browser would submit.
+
+        The pairs are computed once per change to the document made through
+        the element APIs.
+
+        """
+        state = _document_state(self)
+        return list(state.memoized(('form_values', self), self._form_values))
+
+    def _form_values(self):
         results = []
         for name, elements in self.inputs.iteritems():
             if not name:
@@ -379,29 +843,32 @@ class MultipleSelectOptions(SetMixin):
             if 'selected' in option.attrib:
                 yield _value_from_option(option)
 
+    def _option(self, item):
+        """The first option with value *item*, or None."""
+        options = _document_state(self.select).options_by_value(
+            self.select).get(item)
+        if not options:
+            return None
+        return options[0]
+
     def add(self, item):
-        for option in self.options:
-            opt_value = _value_from_option(option)
-            if opt_value == item:
-                option.set('selected', '')
-                break
-        else:
+        option = self._option(item)
+        if option is None:
             raise ValueError(
                 "There is no option with the value %r" % item)
+        option.set('selected', '')
+        _changed(self.select)
 
     def remove(self, item):
-        for option in self.options:
-            opt_value = _value_from_option(option)
-            if opt_value == item:
-                if 'selected' in option.attrib:
-                    del option.attrib['selected']
-                else:
-                    raise ValueError(
-                        "The option %r is not currently selected" % item)
-                break
-        else:
+        option = self._option(item)
+        if option is None:
             raise ValueError(
                 "There is not option with the value %r" % item)
+        if 'selected' not in option.attrib:
+            raise ValueError(
+                "The option %r is not currently selected" % item)
+        del option.attrib['selected']
+        _changed(self.select)
 
     def __repr__(self):
         return '<%s {%s} for select name=%r>' % (
@@ -448,19 +915,17 @@ class SelectElement(_InputControl):
             return
         if value is not None:
             value = value.strip()
-            for el in _options_xpath(self):
-                opt_value = _value_from_option(el)
-                if opt_value == value:
-                    checked_option = el
-                    break
-            else:
+            options = _document_state(self).options_by_value(self).get(value)
+            if not options:
                 raise ValueError(
                     "There is no option with the value of %r" % value)
+            checked_option = options[0]
         for el in _options_xpath(self):
             if 'selected' in el.attrib:
                 del el.attrib['selected']
         if value is not None:
             checked_option.set('selected', '')
+        _changed(self)
 
     def _value__del(self):
         # FIXME: should del be allowed at all?
@@ -517,6 +982,14 @@ def _append_text_value(existing, new, allow_multiline):
 
 class InputElement(_InputControl):
 
+    def _value__set(self, value):
+        lxml_html.InputElement.value.fset(self, value)
+        _changed(self)
+
+    value = property(lxml_html.InputElement.value.fget, _value__set,
+                     lxml_html.InputElement.value.fdel,
+                     doc=lxml_html.InputElement.value.__doc__)
+
     def enter(self, text):
         """Append *text* into the value of the input field."""
         if self.type not in ('text', 'radio'):
@@ -545,15 +1018,23 @@ class InputElement(_InputControl):
                     el.set('checked', '')
                 else:
                     el.attrib.pop('checked', None)
-            return
-        if value:
+        elif value:
             self.set('checked', '')
-        elif have:
+        else:
             del self.attrib['checked']
+        _changed(self)
 
 
 class TextareaElement(_InputControl):
 
+    def _value__set(self, value):
+        lxml_html.TextareaElement.value.fset(self, value)
+        _changed(self)
+
+    value = property(lxml_html.TextareaElement.value.fget, _value__set,
+                     lxml_html.TextareaElement.value.fdel,
+                     doc=lxml_html.TextareaElement.value.__doc__)
+
     def enter(self, text):
         """Append *text* into the value of the field."""
         self.value = _append_text_value(self.value, text, True)
@@ -573,13 +1054,38 @@ base_elements = {
     }
 
 
+_lookup_serial = count()
+_lookups = {}
+_lookups_lock = threading.Lock()
+
+
+def element_lookup(mixins):
+    """Return the shared :class:`ElementLookup` for *mixins*."""
+    key = tuple(to_pairs(mixins))
+    lookup = _lookups.get(key)
+    if lookup is None:
+        _lookups_lock.acquire()
+        try:
+            lookup = _lookups.get(key)
+            if lookup is None:
+                lookup = _lookups[key] = ElementLookup(key)
+        finally:
+            _lookups_lock.release()
+    return lookup
+
+
 class ElementLookup(lxml_html.HtmlElementClassLookup):
 
     # derived from the lxml class
 
-    def __init__(self, browser, mixins):
+    def __init__(self, mixins):
         lxml_html.HtmlElementClassLookup.__init__(self)
         mixins = list(to_pairs(mixins))
+        # trees are only interchangeable between parsers sharing the element
+        # classes of this lookup.  elements find their browser through
+        # their document, so browsers with the same mixins share a lookup.
+        self.cache_key = _lookup_serial.next()
+        browser = property(_element_browser)
 
         mix_all = tuple(cls for name, cls in mixins if name == '*')
 
@@ -631,12 +1137,22 @@ class InputGetter(lxml_html.InputGetter):
     """
 
     def __getitem__(self, name):
-        results = self._name_xpath(self.form, name=name)
+        names, by_name = _document_state(self.form).form_fields(self.form)
+        results = by_name.get(name)
         if not results:
             raise KeyError("No input element with the name %r" % name)
-        return results
+        return list(results)
         # TODO:             group = RadioGroup(results)
 
+    def __contains__(self, name):
+        names, by_name = _document_state(self.form).form_fields(self.form)
+        return name in by_name
+
+    def keys(self):
+        """Field names, in document order."""
+        names, by_name = _document_state(self.form).form_fields(self.form)
+        return list(names)
+
     def iteritems(self):
         for name in self.keys():
             yield (name, self[name])
@@ -649,25 +1165,28 @@ class FieldsDict(DictMixin):
 
     class CheckableProxy(lxml_html.CheckboxValues):
 
+        @lazy_property
+        def _by_value(self):
+            by_value = {}
+            for el in self.group:
+                by_value.setdefault(el.get('value', 'on'), el)
+            return by_value
+
         def __iter__(self):
             for el in self.group:
                 if el.checked:
                     yield el.get('value', 'on')
 
         def add(self, value):
-            for el in self.group:
-                if el.get('value', 'on') == value:
-                    el.checked = True
-                    break
-            else:
+            try:
+                self._by_value[value].checked = True
+            except KeyError:
                 raise KeyError("No checkbox with value %r" % value)
 
         def remove(self, value):
-            for el in self.group:
-                if el.get('value', 'on') == value:
-                    el.checked = False
-                    break
-            else:
+            try:
+                self._by_value[value].checked = False
+            except KeyError:
                 raise KeyError("No checkbox with value %r" % value)
 
         def __repr__(self):
@@ -742,14 +1261,15 @@ def _group_key_value_pairs(values, with_prefix=''):
       prefix, it will be prepended.
 
     """
-    grouped = defaultdict(list)
+    grouped = {}
     transformed_keys = []
     for key, value in to_pairs(values):
         if with_prefix and not key.startswith(with_prefix):
             key = with_prefix + key
-        grouped[key].append(value)
-        if key not in transformed_keys:
+        if key not in grouped:
+            grouped[key] = []
             transformed_keys.append(key)
+        grouped[key].append(value)
     return [(key, grouped[key]) for key in transformed_keys]
 
 
@@ -0,0 +1,165 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Selector queries over markup too large to parse into a tree."""
+
+from cssselect import parse
+from cssselect.parser import Attrib, Class, CombinedSelector, Element, Hash
+from lxml import html as lxml_html
+from lxml.etree import TreeBuilder
+
+
+__all__ = ['stream_query']
+
+
+def stream_query(chunks, selectors, parser=None):
+    """Yield (selector, element) for each match of *selectors* in *chunks*.
+
+    :param chunks: an iterable of markup strings, fed to the parser in turn.
+
+    :param selectors: a CSS selector or a sequence of them.  Selectors are
+      limited to type, class, id and attribute tests combined with
+      descendant and child combinators.
+
+    :param parser: optional, a parser whose element classes are used for the
+      matched elements.
+
+    Only the open elements and the subtrees of matches still being read are
+    held in memory.  Matches are yielded as soon as their end tag is read,
+    so a match is yielded before any match enclosing it.
+
+    """
+    if isinstance(selectors, basestring):
+        selectors = [selectors]
+    compiled = []
+    for source in selectors:
+        for selector in parse(source):
+            if selector.pseudo_element is not None:
+                raise ValueError("Pseudo-elements are not supported in "
+                                 "streaming queries: %r" % source)
+            _check_supported(selector.parsed_tree, source)
+            compiled.append((source, selector.parsed_tree))
+
+    target = _QueryTarget(compiled, parser)
+    stream_parser = lxml_html.HTMLParser(target=target)
+    for chunk in chunks:
+        stream_parser.feed(chunk)
+        if target.matches:
+            for match in target.matches:
+                yield match
+            del target.matches[:]
+    stream_parser.close()
+    for match in target.matches:
+        yield match
+
+
+_supported = (Attrib, Class, CombinedSelector, Element, Hash)
+
+
+def _check_supported(node, source):
+    if not isinstance(node, _supported):
+        raise ValueError("%s is not supported in streaming queries: %r" % (
+            type(node).__name__, source))
+    if isinstance(node, CombinedSelector):
+        if node.combinator not in (' ', '>'):
+            raise ValueError("The %r combinator is not supported in "
+                             "streaming queries: %r" % (
+                                 node.combinator, source))
+        _check_supported(node.selector, source)
+        _check_supported(node.subselector, source)
+    elif not isinstance(node, Element):
+        _check_supported(node.selector, source)
+
+
+class _QueryTarget(object):
+    """A parser target matching selectors against the open elements."""
+
+    def __init__(self, selectors, parser):
+        self.selectors = selectors
+        self.parser = parser
+        # (tag, attrib) of each open element, outermost first
+        self.stack = []
+        # (depth, selector source, builder) of each match being read
+        self.builders = []
+        self.matches = []
+
+    def start(self, tag, attrib):
+        attrib = dict(attrib)
+        stack = self.stack
+        stack.append((tag, attrib))
+        for depth, source, builder in self.builders:
+            builder.start(tag, attrib)
+        index = len(stack) - 1
+        for source, selector in self.selectors:
+            if _matches(selector, stack, index):
+                builder = TreeBuilder(parser=self.parser)
+                builder.start(tag, attrib)
+                self.builders.append((len(stack), source, builder))
+
+    def end(self, tag):
+        depth = len(self.stack)
+        open_builders = []
+        for entry in self.builders:
+            entry[2].end(tag)
+            if entry[0] == depth:
+                self.matches.append((entry[1], entry[2].close()))
+            else:
+                open_builders.append(entry)
+        self.builders = open_builders
+        self.stack.pop()
+
+    def data(self, data):
+        for depth, source, builder in self.builders:
+            builder.data(data)
+
+    def close(self):
+        return None
+
+
+def _matches(node, stack, index):
+    """True if *node* matches the open element at *stack[index]*."""
+    tag, attrib = stack[index]
+    if isinstance(node, Element):
+        return node.element in (None, '*') or node.element.lower() == tag
+    if isinstance(node, CombinedSelector):
+        if not _matches(node.subselector, stack, index):
+            return False
+        if node.combinator == '>':
+            return index > 0 and _matches(node.selector, stack, index - 1)
+        for ancestor in xrange(index - 1, -1, -1):
+            if _matches(node.selector, stack, ancestor):
+                return True
+        return False
+    if not _matches(node.selector, stack, index):
+        return False
+    if isinstance(node, Class):
+        return node.class_name in attrib.get('class', '').split()
+    if isinstance(node, Hash):
+        return attrib.get('id') == node.id
+    return _attrib_matches(node, attrib)
+
+
+def _attrib_matches(node, attrib):
+    value = attrib.get(node.attrib)
+    if value is None:
+        return False
+    operator = node.operator
+    if operator == 'exists':
+        return True
+    expected = getattr(node.value, 'value', node.value)
+    if operator == '=':
+        return value == expected
+    if operator == '~=':
+        return expected in value.split()
+    if operator == '|=':
+        return value == expected or value.startswith(expected + '-')
+    if operator == '^=':
+        return bool(expected) and value.startswith(expected)
+    if operator == '$=':
+        return bool(expected) and value.endswith(expected)
+    if operator == '*=':
+        return bool(expected) and expected in value
+    return False
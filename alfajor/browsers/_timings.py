@@ -0,0 +1,166 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Per-phase timing of browser requests."""
+
+from collections import deque
+from math import ceil
+from time import time
+
+
+__all__ = ['PHASES', 'Timings', 'TimingHistory']
+
+PHASES = ('environ', 'app', 'drain', 'cookies', 'parse', 'redirect',
+          'history', 'signals')
+"""The phases a request is divided into, in the order they usually occur.
+
+environ
+  Building the request: the WSGI environ, URL and input encoding.
+app
+  Calling the application (or remote server) until it starts responding.
+drain
+  Reading the response body.
+cookies
+  Extracting cookies from the response.
+parse
+  Building the DOM from the response.
+redirect
+  Deciding whether and where to follow redirects and meta refreshes.
+history
+  Storing the page left in the browser's back/forward history.
+signals
+  Dispatching before/after browser activity signals.
+
+"""
+
+_application_phases = frozenset(['app', 'drain'])
+
+
+class Timings(object):
+    """The time spent in each phase of a single request.
+
+    Time is charged with :meth:`mark`, which attributes everything since the
+    previous mark to a phase, so the phases of a request add up to its wall
+    clock time.  Phases never entered report 0.0.
+
+    """
+
+    def __init__(self, method=None, url=None):
+        self.method = method
+        self.url = url
+        self.phases = {}
+        self.started = self._lap = time()
+
+    def mark(self, phase):
+        """Charge the time since the previous mark to *phase*.
+
+        Returns the current time.
+
+        """
+        now = time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + (now - self._lap)
+        self._lap = now
+        return now
+
+    def record(self, phase, seconds):
+        """Charge *seconds*, measured elsewhere, to *phase*.
+
+        The seconds are excluded from the interval in progress, so the same
+        time is not charged twice by the next :meth:`mark`.
+
+        """
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+        self._lap += seconds
+
+    def __getitem__(self, phase):
+        return self.phases.get(phase, 0.0)
+
+    @property
+    def total(self):
+        """Seconds spent in all phases."""
+        return sum(self.phases.itervalues())
+
+    @property
+    def application(self):
+        """Seconds spent in the application: the 'app' and 'drain' phases."""
+        return sum(self[phase] for phase in _application_phases)
+
+    @property
+    def overhead(self):
+        """Seconds spent in the browser rather than the application."""
+        return self.total - self.application
+
+    def __repr__(self):
+        phases = ', '.join('%s=%0.4f' % (phase, self.phases[phase])
+                           for phase in PHASES if phase in self.phases)
+        return '<Timings %s %s: %s>' % (self.method, self.url, phases)
+
+
+class TimingHistory(object):
+    """A rolling window of the most recent :class:`Timings` of a browser.
+
+    Records are kept by reference, so time charged after a request has
+    completed (such as parsing its document on first access) is included.
+
+    """
+
+    def __init__(self, size=1000):
+        self.size = size
+        self._records = deque()
+
+    def add(self, timings):
+        """Append *timings*, discarding the oldest record if full."""
+        records = self._records
+        records.append(timings)
+        if len(records) > self.size:
+            records.popleft()
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        self._records.clear()
+
+    def values(self, phase):
+        """Sorted seconds for *phase*, or 'total', 'application' or
+        'overhead', across the window."""
+        if phase in ('total', 'application', 'overhead'):
+            values = [getattr(record, phase) for record in self._records]
+        else:
+            values = [record[phase] for record in self._records]
+        values.sort()
+        return values
+
+    def percentile(self, phase, percent):
+        """The *percent* percentile of *phase* (nearest rank), or None."""
+        return _percentile(self.values(phase), percent)
+
+    def summary(self, percents=(50, 90, 99)):
+        """A mapping of phase to percentiles for every phase and the totals.
+
+        Each value is a tuple with one entry per percent in *percents*.
+
+        """
+        summary = {}
+        for phase in PHASES + ('application', 'overhead', 'total'):
+            values = self.values(phase)
+            summary[phase] = tuple(_percentile(values, percent)
+                                   for percent in percents)
+        return summary
+
+    def __repr__(self):
+        return '<TimingHistory %s/%s>' % (len(self._records), self.size)
+
+
+def _percentile(values, percent):
+    """Nearest-rank *percent* percentile of sorted *values*."""
+    if not values:
+        return None
+    rank = int(ceil(percent / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
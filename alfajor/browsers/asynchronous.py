@@ -0,0 +1,245 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Many interleaved browser sessions driven from a single loop.
+
+Sessions are generator functions.  A session yields wherever it would block
+and is resumed with the result once it is available::
+
+  def shopper(browser, item):
+      yield browser.open('/shop')
+      browser.document.forms[0].fill({'q': item})
+      yield browser.document.forms[0].submit()
+      assert browser.status_code == 200
+      raise Return(browser.document['#total'][0].text)
+
+  loop = SessionLoop(size=8)
+  totals = [loop.spawn(shopper, AsyncWSGI(loop, app), item)
+            for item in items]
+  loop.run()
+  print [total.result() for total in totals]
+
+Navigation by an :class:`AsyncWSGI` or :class:`AsyncNetwork` browser (opening
+a page, submitting a form, following a link) returns a
+:class:`~alfajor.utilities.Future`; the request runs on the loop's worker
+threads while other sessions continue.  Everything else, including DOM
+queries and form filling, happens on the loop's own thread.  Thousands of
+sessions share *size* worker threads.
+
+A session may also yield a list of futures, to wait for all of them, or
+another session generator, to run it to completion.  ``raise Return(value)``
+ends a session with a result.
+
+"""
+
+import Queue
+import sys
+import threading
+from types import GeneratorType
+
+from alfajor.browsers.network import Network
+from alfajor.browsers.wsgi import WSGI
+from alfajor.utilities import Future, ThreadPool
+
+
+__all__ = ['AsyncNetwork', 'AsyncWSGI', 'Return', 'SessionLoop']
+
+
+class Return(Exception):
+    """Raised by a session generator to finish with *value*."""
+
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class SessionLoop(object):
+    """Steps session generators, running blocking calls on worker threads.
+    """
+
+    def __init__(self, size=4):
+        self._pool = ThreadPool(size)
+        self._ready = Queue.Queue()
+        self._running = 0
+
+    def submit(self, fn, *args, **kw):
+        """Run *fn(\*args, \*\*kw)* on a worker thread, returning a Future."""
+        return self._pool.submit(fn, *args, **kw)
+
+    def spawn(self, session, *args, **kw):
+        """Start *session(\*args, \*\*kw)* and return a Future for its result.
+
+        The session runs when :meth:`run` is called.
+
+        """
+        future = Future()
+        self._running += 1
+        self._ready.put((_Task(session(*args, **kw), future), None, None))
+        return future
+
+    def run(self):
+        """Run until every spawned session has finished."""
+        while self._running:
+            task, value, exc_info = self._ready.get()
+            self._step(task, value, exc_info)
+
+    def run_until_complete(self, session, *args, **kw):
+        """Run *session* (and any others spawned) and return its result."""
+        future = self.spawn(session, *args, **kw)
+        self.run()
+        return future.result()
+
+    def close(self, wait=True):
+        """Shut down the worker threads."""
+        self._pool.close(wait)
+
+    def _step(self, task, value, exc_info):
+        while True:
+            try:
+                if exc_info is not None:
+                    yielded = task.generator.throw(*exc_info)
+                else:
+                    yielded = task.generator.send(value)
+            except (StopIteration, Return), exc:
+                value = getattr(exc, 'value', None)
+                exc_info = None
+                if task.callers:
+                    task.generator = task.callers.pop()
+                    continue
+                self._finish(task, value, None)
+                return
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                value, exc_info = None, sys.exc_info()
+                if task.callers:
+                    task.generator = task.callers.pop()
+                    continue
+                self._finish(task, None, exc_info)
+                return
+
+            value = exc_info = None
+            if isinstance(yielded, GeneratorType):
+                task.callers.append(task.generator)
+                task.generator = yielded
+            elif isinstance(yielded, (list, tuple)):
+                self._wait(task, _gather(yielded))
+                return
+            elif isinstance(yielded, Future):
+                self._wait(task, yielded)
+                return
+            else:
+                # not a pending operation; resume straight away
+                value = yielded
+
+    def _wait(self, task, future):
+        def resume(future):
+            if future._exc_info is not None:
+                self._ready.put((task, None, future._exc_info))
+            else:
+                self._ready.put((task, future._result, None))
+        future.add_done_callback(resume)
+
+    def _finish(self, task, value, exc_info):
+        self._running -= 1
+        if exc_info is not None:
+            task.future.set_exception(exc_info)
+        else:
+            task.future.set_result(value)
+
+
+class _Task(object):
+    """A running session: its current generator and those waiting on it."""
+
+    __slots__ = 'generator', 'future', 'callers'
+
+    def __init__(self, generator, future):
+        self.generator = generator
+        self.future = future
+        self.callers = []
+
+
+def _gather(futures):
+    """A Future for the results of all *futures*, or the first failure."""
+    gathered = Future()
+    results = [None] * len(futures)
+    pending = [len(futures)]
+    lock = threading.Lock()
+    if not futures:
+        gathered.set_result(results)
+        return gathered
+
+    def collect(index):
+        def done(future):
+            lock.acquire()
+            try:
+                if gathered.done():
+                    return
+                if future._exc_info is not None:
+                    gathered.set_exception(future._exc_info)
+                    return
+                results[index] = future._result
+                pending[0] -= 1
+                if pending[0]:
+                    return
+            finally:
+                lock.release()
+            gathered.set_result(results)
+        return done
+
+    for index, future in enumerate(futures):
+        if not isinstance(future, Future):
+            future = _completed(future)
+        future.add_done_callback(collect(index))
+    return gathered
+
+
+def _completed(value=None):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class AsyncWSGI(WSGI):
+    """A :class:`~alfajor.browsers.wsgi.WSGI` browser for a
+    :class:`SessionLoop`.
+
+    :meth:`open`, :meth:`wait_for` and element actions that navigate return
+    futures.  The application is called on the loop's worker threads, with
+    ``wsgi.multithread`` set.
+
+    """
+
+    def __init__(self, loop, wsgi_app, base_url=None, **options):
+        options.setdefault('multithread', True)
+        WSGI.__init__(self, wsgi_app, base_url, **options)
+        self.loop = loop
+
+    def _open(self, *args, **kw):
+        return self.loop.submit(WSGI._open, self, *args, **kw)
+
+    def wait_for(self, condition, timeout=None):
+        return _completed()
+
+
+class AsyncNetwork(Network):
+    """A :class:`~alfajor.browsers.network.Network` browser for a
+    :class:`SessionLoop`.
+
+    Requests are made on the loop's worker threads, so a slow server holds up
+    only the sessions waiting on it.
+
+    """
+
+    def __init__(self, loop, base_url=None, **options):
+        Network.__init__(self, base_url, **options)
+        self.loop = loop
+
+    def _open(self, *args, **kw):
+        return self.loop.submit(Network._open, self, *args, **kw)
+
+    def wait_for(self, condition, timeout=None):
+        return _completed()
@@ -14,6 +14,37 @@ from alfajor.utilities import ServerSubProcess, eval_dotted_path, lazy_property
 logger = getLogger('alfajor')
 
 
+def _boolean(value):
+    """Interpret an ini file flag."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+def _document_cache(config):
+    """The process-wide document cache if enabled by *config*, else None."""
+    if not _boolean(config.get('document-cache', False)):
+        return None
+    from alfajor.browsers._lxml import shared_document_cache
+    return shared_document_cache
+
+
+def _http_cache(config):
+    """A new HTTP cache for one browser if enabled by *config*, else None."""
+    if not _boolean(config.get('http-cache', False)):
+        return None
+    from alfajor.browsers._httpcache import HTTPCache
+    return HTTPCache()
+
+
+def _history(config):
+    """A new back/forward history if enabled by *config*, else None."""
+    if not _boolean(config.get('history', False)):
+        return None
+    from alfajor.browsers._history import History
+    return History()
+
+
 def _verify_backend_config(config, required_keys):
     missing = [key for key in required_keys if key not in config]
     if not missing:
@@ -114,6 +145,7 @@ class WSGIManager(object):
 
     def __init__(self, frontend_name, backend_config, runner_options):
         self.config = backend_config
+        self.recorder = None
 
     def create(self):
         from alfajor.browsers.wsgi import WSGI
@@ -122,11 +154,29 @@ class WSGIManager(object):
         app = eval_dotted_path(entry_point)
 
         base_url = self.config.get('base_url')
+        streaming = _boolean(self.config.get('streaming', False))
+        max_redirects = self.config.get('max-redirects')
+        if max_redirects is not None:
+            max_redirects = int(max_redirects)
+        traffic_log = self.config.get('record-traffic')
+        if traffic_log and self.recorder is None:
+            # browsers created before destroy() share one open log
+            from alfajor.browsers.replay import TrafficRecorder
+            self.recorder = TrafficRecorder(traffic_log)
+            logger.debug("Recording traffic to %s", traffic_log)
         logger.debug("Created in-process WSGI browser.")
-        return WSGI(app, base_url)
+        return WSGI(app, base_url, streaming=streaming,
+                    document_cache=_document_cache(self.config),
+                    max_redirects=max_redirects,
+                    http_cache=_http_cache(self.config),
+                    recorder=self.recorder,
+                    history=_history(self.config))
 
     def destroy(self):
         logger.debug("Destroying in-process WSGI browser.")
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
 
 
 class NetworkManager(object):
@@ -169,7 +219,9 @@ class NetworkManager(object):
             logger.debug("Starting service....")
             self.process = self.start_subprocess()
             logger.debug("Service started.")
-        self.browser = Network(base_url)
+        self.browser = Network(base_url,
+                               document_cache=_document_cache(self.config),
+                               http_cache=_http_cache(self.config))
         return self.browser
 
     def destroy(self):
@@ -189,6 +241,30 @@ class NetworkManager(object):
         return process
 
 
+class ReplayManager(object):
+    """Lifecycle manager for browsers replaying recorded WSGI traffic.
+
+    traffic-log
+      a log written by a WSGI browser with ``record-traffic`` set
+
+    """
+
+    def __init__(self, frontend_name, backend_config, runner_options):
+        self.config = backend_config
+        _verify_backend_config(self.config, ('traffic-log',))
+
+    def create(self):
+        from alfajor.browsers.replay import Replay
+
+        traffic_log = self.config['traffic-log']
+        logger.debug("Replaying traffic from %s", traffic_log)
+        return Replay(traffic_log, self.config.get('base_url'),
+                      document_cache=_document_cache(self.config))
+
+    def destroy(self):
+        logger.debug("Destroying replay browser.")
+
+
 class ZeroManager(object):
     """Lifecycle manager for global Zero browsers."""
 
@@ -12,12 +12,12 @@ from logging import getLogger
 import urllib2
 from urllib import urlencode
 from urlparse import urljoin
-from time import time
 
 from blinker import signal
 from werkzeug import Headers
 
 from alfajor.browsers._lxml import DOMMixin, html_parser_for
+from alfajor.browsers._timings import Timings
 from alfajor.browsers._waitexpr import WaitExpression
 from alfajor.browsers.wsgi import wsgi_elements
 from alfajor.utilities import lazy_property
@@ -35,6 +35,7 @@ class Network(DOMMixin):
     capabilities = [
         'cookies',
         'headers',
+        'visibility',
         ]
 
     wait_expression = WaitExpression
@@ -45,14 +46,21 @@ class Network(DOMMixin):
         'version': '1.0',
         }
 
-    def __init__(self, base_url=None):
+    http_cache = None
+    """An optional :class:`~alfajor.browsers._httpcache.HTTPCache`."""
+
+    def __init__(self, base_url=None, document_cache=None, http_cache=None):
         # accept additional request headers?  (e.g. user agent)
         self._base_url = base_url
+        if document_cache is not None:
+            self.document_cache = document_cache
+        if http_cache is not None:
+            self.http_cache = http_cache
         self.reset()
 
     def open(self, url, wait_for=None, timeout=0):
         """Open web page at *url*."""
-        self._open(url)
+        return self._open(url)
 
     def reset(self):
         self._referrer = None
@@ -114,10 +122,26 @@ class Network(DOMMixin):
     def _lxml_parser(self):
         return html_parser_for(self, wsgi_elements)
 
+    def _fetch_resource(self, url):
+        """GET *url* for the current page, without leaving it."""
+        request = urllib2.Request(url)
+        if self._referrer:
+            request.add_header('Referer', self._referrer)
+        try:
+            response = self._opener.open(request)
+        except urllib2.URLError, exc:
+            logger.debug("Resource %s: %s", url, exc)
+            return None
+        try:
+            return response.read()
+        finally:
+            response.close()
+
     def _open(self, url, method='GET', data=None, refer=True,
               content_type=None):
+        self.last_timings = timings = Timings(method, url)
         before_browser_activity.send(self)
-        open_started = time()
+        timings.mark('signals')
 
         if data:
             data = urlencode(data)
@@ -143,27 +167,72 @@ class Network(DOMMixin):
             request.add_header('Referer', self._referrer)
 
         logger.info('%s(%s)', url, method)
-        request_started = time()
-
-        response = self._opener.open(request)
-
-        request_ended = time()
+        cached = None
+        if self.http_cache is not None:
+            # cookies are added inside open(); Vary: Cookie is not honored
+            request_headers = dict((name.lower(), value)
+                                   for name, value in request.header_items())
+            cached = self.http_cache.lookup(method, url, request_headers.get)
+        timings.mark('environ')
+
+        if cached is not None and cached.is_fresh():
+            logger.debug("Fresh in HTTP cache")
+            self.http_cache.hit(cached)
+            response, headers, location = None, cached.headers, url
+        else:
+            if cached is not None:
+                for name, value in cached.conditional_headers():
+                    request.add_header(name, value)
+            # urllib2 extracts cookies and follows redirects within open()
+            try:
+                response = self._opener.open(request)
+            except urllib2.HTTPError, exc:
+                if cached is None or exc.code != 304:
+                    raise
+                logger.debug("Not modified, served from HTTP cache")
+                headers = self.http_cache.revalidated(
+                    cached, _header_pairs(exc.info()))
+                response, location = None, exc.geturl()
+            else:
+                cached = None
+                headers = _header_pairs(response.info())
+                location = response.geturl()
+        timings.mark('app')
 
-        self.status_code = response.getcode()
-        self.headers = Headers(
-            (head.strip().split(': ',1) for head in response.info().headers)
-        )
+        if cached is not None:
+            self.status_code = int(cached.status.split(None, 1)[0])
+        else:
+            self.status_code = response.getcode()
+        self.headers = Headers(headers)
         self._referrer = request.get_full_url()
-        self.location = response.geturl()
+        self.location = location
         self._response = response
-        self.response = ''.join(list(response))
+        if cached is not None:
+            self.response = cached.body
+        else:
+            self.response = ''.join(list(response))
         self._sync_document()
-
-        open_ended = time()
-        request_time = request_ended - request_started
+        if self.http_cache is not None:
+            if cached is None and location == url:
+                cached = self.http_cache.store(
+                    method, url, '%s %s' % (self.status_code, response.msg),
+                    headers, self.response, request_headers.get)
+            self._page_document_cache = (
+                cached is not None and self.http_cache.documents or None)
+        timings.mark('drain')
 
         logger.info("Fetched %s in %0.3fsec + %0.3fsec browser overhead",
-                    url, request_time,
-                    open_ended - open_started - request_time)
+                    url, timings.application, timings.overhead)
         after_browser_activity.send(self)
-
+        timings.mark('signals')
+        self.timing_history.add(timings)
+
+
+def _header_pairs(message):
+    """(name, value) pairs of the headers in an httplib *message*."""
+    pairs = []
+    for line in message.headers:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            pairs.append((name.strip(), value.strip()))
+    return pairs
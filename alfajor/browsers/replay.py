@@ -0,0 +1,269 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Recording of WSGI browser traffic, and a browser that replays it.
+
+A :class:`TrafficRecorder` given to a :class:`~alfajor.browsers.wsgi.WSGI`
+browser appends every request and response to a log file::
+
+  recorder = TrafficRecorder('traffic.log')
+  browser = WSGI(app, 'http://localhost', recorder=recorder)
+
+The log holds one JSON record per line.  Bodies are stored once, as
+compressed ``body`` records keyed by their SHA-1, and ``exchange`` records
+refer to them by hash, so a page fetched a thousand times costs one copy.
+
+The :class:`Replay` browser serves the recorded responses without an
+application, and :class:`TrafficLog` reads the log back for other uses,
+such as replaying the requests against a live server.
+
+"""
+
+from base64 import b64decode, b64encode
+from hashlib import sha1
+from logging import getLogger
+import threading
+from time import time
+from wsgiref.util import request_uri
+import zlib
+
+from alfajor.browsers.wsgi import WSGI
+from alfajor._compat import json_dumps as dumps, json_loads as loads
+
+
+__all__ = ['Exchange', 'Replay', 'ReplayApplication', 'TrafficLog',
+           'TrafficRecorder']
+logger = getLogger('tests.browser')
+
+
+class TrafficRecorder(object):
+    """Appends request/response exchanges to the log at *path*.
+
+    Recording into an existing log continues it; bodies already in the log
+    are not stored again.  A recorder may be shared by browsers on several
+    threads.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._bodies = set()
+        try:
+            for record in _read_records(path):
+                if record['type'] == 'body':
+                    self._bodies.add(record['hash'])
+        except IOError:
+            pass
+        self._log = open(path, 'ab')
+
+    def record(self, environ, status, headers, body, request_body=None,
+               seconds=None):
+        """Append one exchange.
+
+        :param environ: the request environ.  Only string, number and boolean
+          values are kept, so streams and other objects are left out.
+        :param headers: the response headers, a list of (name, value).
+        :param request_body: the request body, if known.
+
+        """
+        lines = []
+        self._lock.acquire()
+        try:
+            body_hash = self._store(body, lines)
+            request_body_hash = None
+            if request_body:
+                request_body_hash = self._store(request_body, lines)
+            lines.append(dumps({
+                'type': 'exchange',
+                'url': request_uri(environ),
+                'environ': dict((key, value)
+                                for key, value in environ.iteritems()
+                                if isinstance(value, _plain_types)),
+                'request_body': request_body_hash,
+                'status': status,
+                'headers': [list(header) for header in headers],
+                'body': body_hash,
+                'seconds': seconds,
+                'time': time(),
+                }))
+            self._log.write('\n'.join(lines) + '\n')
+            self._log.flush()
+        finally:
+            self._lock.release()
+
+    def _store(self, body, lines):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        digest = sha1(body).hexdigest()
+        if digest not in self._bodies:
+            self._bodies.add(digest)
+            lines.append(dumps({
+                'type': 'body',
+                'hash': digest,
+                'data': b64encode(zlib.compress(body)),
+                }))
+        return digest
+
+    def close(self):
+        self._log.close()
+
+
+_plain_types = (basestring, int, long, float, bool)
+
+
+class Exchange(object):
+    """A recorded request and its response."""
+
+    def __init__(self, record, bodies):
+        self.url = record['url']
+        self.environ = record['environ']
+        self.method = self.environ.get('REQUEST_METHOD', 'GET')
+        self.status = record['status']
+        self.headers = [tuple(header) for header in record['headers']]
+        self.seconds = record.get('seconds')
+        self._body = record['body']
+        self._request_body = record.get('request_body')
+        self._bodies = bodies
+
+    @property
+    def body(self):
+        """The response body."""
+        return self._bodies[self._body]
+
+    @property
+    def request_body(self):
+        """The request body, or None if it was not recorded."""
+        if self._request_body is None:
+            return None
+        return self._bodies[self._request_body]
+
+    def request_headers(self):
+        """The request headers as a list of (name, value)."""
+        headers = []
+        for key, value in self.environ.iteritems():
+            if key.startswith('HTTP_'):
+                headers.append((key[5:].replace('_', '-').title(), value))
+            elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH') and value:
+                headers.append((key.replace('_', '-').title(), value))
+        return headers
+
+    def __repr__(self):
+        return '<Exchange %s %s %s>' % (self.method, self.url, self.status)
+
+
+class TrafficLog(object):
+    """The exchanges recorded in the log at *path*, in order."""
+
+    def __init__(self, path):
+        self.path = path
+        self._bodies = _Bodies()
+        self.exchanges = []
+        for record in _read_records(path):
+            if record['type'] == 'body':
+                self._bodies.add(record['hash'], record['data'])
+            elif record['type'] == 'exchange':
+                self.exchanges.append(Exchange(record, self._bodies))
+
+    def __iter__(self):
+        return iter(self.exchanges)
+
+    def __len__(self):
+        return len(self.exchanges)
+
+
+class _Bodies(object):
+    """Compressed bodies by hash, decompressed on first use."""
+
+    def __init__(self):
+        self._compressed = {}
+        self._bodies = {}
+
+    def add(self, digest, data):
+        self._compressed[digest] = data
+
+    def __getitem__(self, digest):
+        try:
+            return self._bodies[digest]
+        except KeyError:
+            body = zlib.decompress(b64decode(self._compressed.pop(digest)))
+            self._bodies[digest] = body
+            return body
+
+
+def _read_records(path):
+    log = open(path, 'rb')
+    try:
+        for line in log:
+            if line.strip():
+                yield loads(line)
+    finally:
+        log.close()
+
+
+class ReplayApplication(object):
+    """A WSGI application answering with the responses in a traffic log.
+
+    Requests are matched on method, path and query string.  A request
+    recorded several times gets the recorded responses in order, then the
+    last one again.  Unrecorded requests get a 404.
+
+    """
+
+    def __init__(self, log):
+        if isinstance(log, basestring):
+            log = TrafficLog(log)
+        self.log = log
+        self._responses = {}
+        self._lock = threading.Lock()
+        for exchange in log:
+            self._responses.setdefault(
+                _request_key(exchange.environ), []).append(exchange)
+        self._served = dict((key, 0) for key in self._responses)
+
+    def __call__(self, environ, start_response):
+        key = _request_key(environ)
+        self._lock.acquire()
+        try:
+            exchanges = self._responses.get(key)
+            if exchanges:
+                index = self._served[key]
+                self._served[key] = min(index + 1, len(exchanges) - 1)
+                exchange = exchanges[index]
+        finally:
+            self._lock.release()
+        if not exchanges:
+            logger.warning("No recorded response for %s %s",
+                           environ['REQUEST_METHOD'], request_uri(environ))
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not recorded']
+        start_response(exchange.status, exchange.headers)
+        return [exchange.body]
+
+    def rewind(self):
+        """Serve each recorded sequence from its start again."""
+        for key in self._served:
+            self._served[key] = 0
+
+
+def _request_key(environ):
+    return (environ.get('REQUEST_METHOD', 'GET'),
+            environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''))
+
+
+class Replay(WSGI):
+    """An in-process browser that replays a traffic log instead of
+    calling an application."""
+
+    user_agent = {
+        'browser': 'replay',
+        'platform': 'python',
+        'version': '1.0',
+        }
+
+    def __init__(self, log, base_url=None, **options):
+        WSGI.__init__(self, ReplayApplication(log), base_url, **options)
@@ -31,6 +31,7 @@ from alfajor.browsers._lxml import (
     _options_xpath,
     html_parser_for,
     )
+from alfajor.browsers._timings import Timings, TimingHistory
 from alfajor.browsers._waitexpr import WebDriverWaitExpression, WaitExpression
 from alfajor.utilities import lazy_property
 from alfajor._compat import property
@@ -91,6 +92,7 @@ class WebDriver(DOMMixin):
         self.headers = {}
         self.selenium = SeleniumCompatibilityShim(self)
         self.wait_expression = kw.pop('wait_expression', self.wait_expression)
+        self._element_ids = {}
 
     def open(self, url, wait_for='page', timeout=None):
         logger.info('open(%s)', url)
@@ -114,6 +116,15 @@ class WebDriver(DOMMixin):
     def current_timeout(self):
         return self.webdriver._current_timeout
 
+    @property
+    def last_timings(self):
+        """The Timings of the last command sent to the WebDriver server."""
+        return self.webdriver.last_timings
+
+    @property
+    def timing_history(self):
+        return self.webdriver.timing_history
+
     def reset(self):
         self.webdriver('DELETE', 'cookie')
 
@@ -129,7 +140,9 @@ class WebDriver(DOMMixin):
     def sync_document(self, wait_for=None, timeout=None):
         self.wait_for(wait_for, timeout)
         self.response = self.webdriver('GET', 'source')['value']
-        self.__dict__.pop('document', None)
+        DOMMixin.sync_document(self)
+        # the page may have changed: element ids are looked up afresh
+        self._element_ids.clear()
 
     @property
     def location(self):
@@ -196,6 +209,46 @@ class WebDriver(DOMMixin):
     def delete_cookie(self, name, domain=None, path=None):
         self.webdriver('DELETE', 'cookie' + '/' + name)
 
+    def _element_id(self, locator):
+        """The WebDriver id of the element at *locator*.
+
+        Ids are remembered until the document is next synchronized.
+
+        """
+        try:
+            return self._element_ids[locator]
+        except KeyError:
+            using, selector = locator
+            id = self.webdriver('POST', 'element', using=using,
+                                value=selector)['value']['ELEMENT']
+            self._element_ids[locator] = id
+            return id
+
+    def _element_call(self, locator, call):
+        """Return *call(id)* with the WebDriver id of the element at *locator*.
+
+        If the remembered id has gone stale, the remembered ids are dropped
+        and *call* is retried once with a fresh one.
+
+        """
+        cached = locator in self._element_ids
+        try:
+            return call(self._element_id(locator))
+        except StaleElementReference:
+            self._element_ids.clear()
+            if not cached:
+                raise
+            return call(self._element_id(locator))
+
+    def visibility(self, elements):
+        """A list of the visibility of each of *elements*, in one request.
+
+        Elements missing from the live page are not visible.
+
+        """
+        return [visible is True for visible in self.webdriver.visibility(
+            [element._locator for element in elements])]
+
     # temporary...
     def stop(self):
         self.webdriver.test_complete()
@@ -246,6 +299,8 @@ class WebDriverRemote(object):
         self._default_timeout = default_timeout
         self._current_timeout = None
         self._req_session = None
+        self.last_timings = None
+        self.timing_history = TimingHistory()
 
     def get_new_browser_session(self, **capabilities):
         self._req_session = requests.Session()
@@ -273,9 +328,14 @@ class WebDriverRemote(object):
 
     def _raw_call(self, method, command, *args, **kw):
         logger.debug('webdriver(%s, %r, %r)', command, args, kw)
+        self.last_timings = timings = Timings(method, command)
+        self.timing_history.add(timings)
+        payload = json.dumps(kw)
+        timings.mark('environ')
         response = self._req_session.request(method,
                                              self._server_url + '/' + command,
-                                             data=json.dumps(kw))
+                                             data=payload)
+        timings.mark('app')
         if not response.status_code < 300:
             exc = RuntimeError
             try:
@@ -289,6 +349,7 @@ class WebDriverRemote(object):
         data = None
         if response.status_code == 200:
             data = response.json()
+        timings.mark('drain')
 
         return data
 
@@ -393,33 +454,33 @@ class WebDriverRemote(object):
         operation = lambda: _find_element(self)
         return self._exec_with_timeout(operation, timeout, frequency)
 
+    def visibility(self, locators):
+        """Check the visibility of several elements in one request.
+
+        :param locators: (strategy, value) pairs, as for an ``element``
+          request.
+
+        Returns True, False or None (for an element not found) for each
+        locator.  An element is visible if it is rendered with a layout box
+        and neither it nor an ancestor is hidden by its ``display``,
+        ``visibility`` or ``opacity``.  Options are visible with their
+        ``<select>``, and image map areas with the image using the map.
+
+        """
+        return self('POST', 'execute', script=_visibility_script,
+                    args=[[list(locator) for locator in locators]])['value']
+
     def wait_for_element_visible(self, expression, timeout=None,
                                  frequency=None):
-        def _element_visible(driver):
-            try:
-                strategy, value = self._to_locator(expression)
-                el = driver('POST', 'element', using=strategy, value=value
-                            )['value']['ELEMENT']
-                displayed = driver('GET', 'element/%s/displayed' % el)['value']
-                return displayed
-            except ElementNotVisible:
-                return False
-        operation = lambda: _element_visible(self)
+        locators = [self._to_locator(expression)]
+        operation = lambda: self.visibility(locators)[0] is True
         return self._exec_with_timeout(operation, timeout, frequency)
 
     def wait_for_element_invisible(self, expression, timeout=None,
                                    frequency=None):
-        def _element_visible(driver):
-            try:
-                strategy, value = self._to_locator(expression)
-                el = driver('POST', 'element', using=strategy, value=value
-                            )['value']['ELEMENT']
-                displayed = driver('GET', 'element/%s/displayed' % el)['value']
-                return not displayed
-            except ElementNotVisible:
-                # if an element doesn't exist, it's invisible, right? or raise?
-                return True
-        operation = lambda: _element_visible(self)
+        # an element that doesn't exist is invisible
+        locators = [self._to_locator(expression)]
+        operation = lambda: self.visibility(locators)[0] is not True
         return self._exec_with_timeout(operation, timeout, frequency)
 
     @contextmanager
@@ -452,6 +513,65 @@ class WebDriverRemote(object):
                 self.set_timeout(current_timeout)
 
 
+_visibility_script = """
+var find = function(using, value) {
+  switch (using) {
+  case 'id': return document.getElementById(value);
+  case 'name': return document.getElementsByName(value)[0];
+  case 'class name': return document.getElementsByClassName(value)[0];
+  case 'tag name': return document.getElementsByTagName(value)[0];
+  case 'css selector': return document.querySelector(value);
+  case 'link text':
+  case 'partial link text':
+    for (var i = 0; i < document.links.length; i++) {
+      var text = document.links[i].textContent.replace(/^\\s+|\\s+$/g, '');
+      if (using == 'link text' ? text == value : text.indexOf(value) >= 0)
+        return document.links[i];
+    }
+    return null;
+  }
+  return document.evaluate(value, document, null,
+                           XPathResult.FIRST_ORDERED_NODE_TYPE,
+                           null).singleNodeValue;
+};
+var enclosing = function(element, tag) {
+  for (; element && element.nodeType == 1; element = element.parentNode)
+    if (element.tagName.toLowerCase() == tag) return element;
+  return null;
+};
+var visible = function(element) {
+  // options and image map areas have no boxes of their own; like
+  // WebDriver's displayed check, they are shown with their select or image
+  var tag = element.tagName.toLowerCase();
+  if (tag == 'option' || tag == 'optgroup') {
+    var select = enclosing(element, 'select');
+    return select ? visible(select) : false;
+  }
+  if (tag == 'area' || tag == 'map') {
+    var map = enclosing(element, 'map');
+    var image = map && map.name &&
+      document.querySelector('img[usemap="#' + map.name + '"]');
+    return image ? visible(image) : false;
+  }
+  if (!element.getClientRects().length) return false;
+  var style = window.getComputedStyle(element);
+  if (style.visibility == 'hidden' || style.visibility == 'collapse')
+    return false;
+  for (; element && element.nodeType == 1; element = element.parentNode) {
+    style = window.getComputedStyle(element);
+    if (style.display == 'none' || style.opacity == '0') return false;
+  }
+  return true;
+};
+var results = [];
+for (var i = 0; i < arguments[0].length; i++) {
+  var element = find(arguments[0][i][0], arguments[0][i][1]);
+  results.push(element ? visible(element) : null);
+}
+return results;
+"""
+
+
 _transformers = {
     'unicode': lambda d: unicode(d, 'utf-8'),
     'int': int,
@@ -477,15 +597,15 @@ def event_sender(name, default_wait_for=None):
             # signalling that page is ready
             self.browser.webdriver('POST', 'execute',
                 script='window.__alfajor_webdriver_page__ = true', args=[])
-        element = self.wd_id()
+        webdriver = self.browser.webdriver
         if 'doubleclick' in name:
-            self.browser.webdriver('POST', 'moveto', element=element)
-            self.browser.webdriver('POST', '%s' % (element, webdriver_name))
+            self._call(lambda id: webdriver('POST', 'moveto', element=id))
+            webdriver('POST', webdriver_name)
         elif name == 'mouse_over':
             # compatibility w/ selenium rc
-            self.browser.webdriver('POST', 'moveto', element=element)
+            self._call(lambda id: webdriver('POST', 'moveto', element=id))
         else:
-            self.browser.webdriver('POST', 'element/%s/%s' % (element, webdriver_name))
+            self._command('POST', webdriver_name)
         # XXX:dc: when would a None wait_for be a good thing?
         if wait_for:
             self.browser.wait_for(wait_for, timeout)
@@ -551,10 +671,7 @@ def _fill_form_async(form, values, wait_for=None, timeout=None):
 
 
 def type_text(element, text, allow_newlines=False):
-    webdriver = element.browser.webdriver
-    # Store the original value
-    webdriver('POST', 'element/%s/value' % element.wd_id(),
-              value=[c for c in text])
+    element._command('POST', 'value', value=[c for c in text])
 
 
 class InputElement(InputElement):
@@ -563,9 +680,7 @@ class InputElement(InputElement):
     @property
     def value(self):
         """The value= of this input."""
-        return self.browser.webdriver('GET',
-                                      'element/%s/value' % self.wd_id()
-                                      )['value']
+        return self._command('GET', 'value')['value']
 
     @value.setter
     def value(self, value):
@@ -591,7 +706,7 @@ class InputElement(InputElement):
                     self.checked = bool(value)
         else:
             self.attrib['value'] = value
-            self.browser.webdriver('POST', 'element/%s/clear' % self.wd_id())
+            self._command('POST', 'clear')
             type_text(self, value)
 
     @value.deleter
@@ -601,16 +716,13 @@ class InputElement(InputElement):
         else:
             if 'value' in self.attrib:
                 del self.attrib['value']
-            self.browser.webdriver('POST', 'element/%s/value' % self.wd_id(),
-                                   value=[])
+            self._command('POST', 'value', value=[])
 
     @property
     def checked(self):
         if not self.checkable:
             raise AttributeError('Not a checkable input type')
-        return self.browser.webdriver('GET',
-                                      'element/%s/selected' % self.wd_id()
-                                      )['value']
+        return self._command('GET', 'selected')['value']
 
     @checked.setter
     def checked(self, value):
@@ -622,13 +734,13 @@ class InputElement(InputElement):
         if self.type == 'radio' and current_state:
             return
         elif self.type == 'radio':
-            self.browser.webdriver('POST', 'element/%s/click' % self.wd_id())
+            self._command('POST', 'click')
             self.attrib['checked'] = ''
             for el in self.form.inputs[self.name]:
                 if el.value != self.value:
                     el.attrib.pop('checked', None)
         else:
-            self.browser.webdriver('POST', 'element/%s/click' % self.wd_id())
+            self._command('POST', 'click')
 
     def set(self, key, value):
         if key != 'checked':
@@ -644,31 +756,22 @@ class TextareaElement(TextareaElement):
     @property
     def value(self):
         """The value= of this input."""
-        return self.browser.webdriver('GET',
-                                      'element/%s/value' % self.wd_id()
-                                      )['value']
+        return self._command('GET', 'value')['value']
 
     @value.setter
     def value(self, value):
         self.attrib['value'] = value
-        self.browser.webdriver('POST', 'element/%s/clear' % self.wd_id())
-        self.browser.webdriver('POST', 'element/%s/value' % self.wd_id(),
-                               value=[c for c in value])
+        self._command('POST', 'clear')
+        self._command('POST', 'value', value=[c for c in value])
 
     def enter(self, text, wait_for='duration', timeout=0.1):
         type_text(self, text)
 
 
-def _get_value_and_locator_from_option(webdriver, option):
-    id = option.wd_id()
+def _option_value(option):
     if 'value' in option.attrib:
-        if option.get('value') is None:
-            value = None
-        else:
-            value = option.get('value')
-    else:
-        value = webdriver('GET', 'element/%s/text' % id)['value']
-    return value, id
+        return option.get('value')
+    return option._command('GET', 'text')['value']
 
 
 class SelectElement(SelectElement):
@@ -685,17 +788,12 @@ class SelectElement(SelectElement):
         else:
             values = [value]
         for el in selected:
-            val, option_locator = _get_value_and_locator_from_option(
-                self.browser.webdriver, el)
+            val = _option_value(el)
             if val not in values:
                 raise AssertionError("Option with value %r not present in "
                                      "remote document!" % val)
-            if self.multiple:
-                self.browser.webdriver('POST',
-                                       'element/%s/click' % option_locator)
-            else:
-                self.browser.webdriver('POST',
-                                       'element/%s/click' % option_locator)
+            el._command('POST', 'click')
+            if not self.multiple:
                 break
         if self.multiple:
             # clear modifier
@@ -723,26 +821,33 @@ class DOMElement(DOMElement):
     focus = event_sender('focus')
 
     def wd_id(self):
-        using, selector = self._locator
-        return self.browser.webdriver('POST', 'element', using=using,
-                                      value=selector)['value']['ELEMENT']
+        """The WebDriver id of this element, looked up once per document."""
+        return self.browser._element_id(self._locator)
+
+    def _call(self, call):
+        """Return *call(id)* with this element's WebDriver id."""
+        return self.browser._element_call(self._locator, call)
+
+    def _command(self, method, command, **kw):
+        """Send an element/<id>/*command* request for this element."""
+        webdriver = self.browser.webdriver
+        return self._call(lambda id: webdriver(
+            method, 'element/%s/%s' % (id, command), **kw))
 
     def fire_event(self, name):
         before_browser_activity.send(self.browser)
         self.browser.webdriver('fireEvent', self._locator, name)
         after_browser_activity.send(self.browser)
 
-    def _is_visible(self):
-        return self.browser.webdriver('GET',
-                                      'element/%s/displayed' % self.wd_id()
-                                      )['value']
-
     @property
     def is_visible(self):
-        if self._is_visible():
-            return all([e._is_visible() for e in self.iterancestors()])
-        else:
-            return False
+        """True if the element is visible in the browser.
+
+        Checked in one request; see :meth:`WebDriver.visibility` to check
+        several elements at once.
+
+        """
+        return self.browser.visibility([self])[0]
 
 
 webdriver_elements = {
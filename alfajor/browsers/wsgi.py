@@ -7,28 +7,29 @@
 """An in-process browser that acts as a WSGI server."""
 
 from __future__ import absolute_import
-import cookielib
-from cookielib import Cookie
+import copy
+from cookielib import Cookie, http2time
 import dummy_threading
 from cStringIO import StringIO
+import threading
 from logging import getLogger
 import os.path
+import re
+from tempfile import SpooledTemporaryFile
+from uuid import uuid4
 from urlparse import urljoin, urlparse, urlunparse
 from time import time
-import urllib2
 from wsgiref.util import request_uri
 
 from blinker import signal
+from lxml.html import tostring
 from werkzeug import (
     BaseResponse,
-    FileStorage,
     MultiDict,
-    create_environ,
     parse_cookie,
     run_wsgi_app,
     url_encode,
     )
-from werkzeug.test import encode_multipart
 
 from alfajor.browsers._lxml import (
     ButtonElement,
@@ -38,15 +39,26 @@ from alfajor.browsers._lxml import (
     InputElement,
     SelectElement,
     TextareaElement,
+    _bind_document,
+    _changed,
+    html_from_string,
     html_parser_for,
     )
+from alfajor.browsers._history import HistoryEntry
+from alfajor.browsers._timings import TimingHistory, Timings
 from alfajor.browsers._waitexpr import WaitExpression
-from alfajor.utilities import lazy_property, to_pairs
+from alfajor.utilities import ThreadPool, lazy_property, to_pairs
+from alfajor._environ import environ_template
 from alfajor._compat import property
 
 
-__all__ = ['WSGI']
+__all__ = ['WSGI', 'WSGIBrowserPool']
 logger = getLogger('tests.browser')
+_looks_like_full_html = re.compile(r'^\s*<(?:html|!doctype)', re.I).match
+_meta_refresh_search = re.compile(
+    r'<meta\s[^>]*http-equiv\s*=\s*["\']?\s*refresh', re.I).search
+_refresh_url_match = re.compile(
+    r'\s*[\d.]*\s*[;,]\s*url\s*=\s*["\']?([^"\'\s]+)', re.I).match
 after_browser_activity = signal('after_browser_activity')
 before_browser_activity = signal('before_browser_activity')
 
@@ -58,6 +70,8 @@ class WSGI(DOMMixin):
         'cookies',
         'headers',
         'status',
+        'upload',
+        'visibility',
         ]
 
     wait_expression = WaitExpression
@@ -74,13 +88,55 @@ class WSGI(DOMMixin):
         'version': '1.0',
         }
 
-    def __init__(self, wsgi_app, base_url=None):
+    max_redirects = 20
+    """The most redirects and meta refreshes followed for one request."""
+
+    redirect_hops = ()
+    """(method, url, status_code, seconds) for each response received by the
+    last request, including redirects."""
+
+    spool_size = 1024 * 1024
+    """Bytes of a streamed response body held in memory before spooling
+    to a temporary file."""
+
+    parse_while_streaming = True
+    """In :attr:`streaming` mode, parse HTML pages as they are read.  Set
+    this to False for pages too large to hold as a tree, and read them
+    with :meth:`stream_query`."""
+
+    http_cache = None
+    """An optional :class:`~alfajor.browsers._httpcache.HTTPCache`."""
+
+    recorder = None
+    """An optional :class:`~alfajor.browsers.replay.TrafficRecorder` that
+    logs every request and response."""
+
+    history = None
+    """An optional :class:`~alfajor.browsers._history.History` of pages
+    visited, enabling :meth:`back` and :meth:`forward`."""
+
+    def __init__(self, wsgi_app, base_url=None, streaming=False,
+                 document_cache=None, multithread=False, max_redirects=None,
+                 http_cache=None, recorder=None, history=None):
         # accept additional request headers?  (e.g. user agent)
         self._wsgi_app = wsgi_app
         self._base_url = base_url
+        self.streaming = streaming
+        if document_cache is not None:
+            self.document_cache = document_cache
+        if http_cache is not None:
+            self.http_cache = http_cache
+        if recorder is not None:
+            self.recorder = recorder
+        if history is not None:
+            self.history = history
+        if multithread:
+            self._wsgi_server = dict(self._wsgi_server, multithread=True)
+        if max_redirects is not None:
+            self.max_redirects = max_redirects
         self._referrer = None
         self._request_environ = None
-        self._cookie_jar = CookieJar()
+        self._cookie_jar = self._new_cookie_jar()
         self._charset = 'utf-8'
         self.status_code = 0
         self.status = ''
@@ -90,10 +146,117 @@ class WSGI(DOMMixin):
 
     def open(self, url, wait_for=None, timeout=0):
         """Open web page at *url*."""
-        self._open(url, refer=False)
+        return self._open(url, refer=False)
+
+    def back(self):
+        """Return to the previous page in :attr:`history`.
+
+        The page is shown as it was received, without a request.  Returns
+        False if there is no previous page or no :attr:`history` is kept.
+
+        """
+        if self.history is None:
+            return False
+        return self._show_entry(
+            self.history.back(self.__dict__.get('document')))
+
+    def forward(self):
+        """Return to the page left by :meth:`back`.
+
+        Returns False if there is no following page or no :attr:`history`
+        is kept.
+
+        """
+        if self.history is None:
+            return False
+        return self._show_entry(
+            self.history.forward(self.__dict__.get('document')))
 
     def reset(self):
-        self._cookie_jar = CookieJar()
+        self._cookie_jar = self._new_cookie_jar()
+
+    def snapshot(self):
+        """Capture the current page and session state.
+
+        The snapshot can be applied to this browser any number of times with
+        :meth:`restore`.  Cookies are shared copy-on-write; the document is
+        copied only if it has been parsed (and so possibly modified).
+
+        """
+        document = self.__dict__.get('document')
+        if document is not None:
+            document = copy.deepcopy(document)
+        return _Snapshot(
+            cookie_jar=self._cookie_jar.copy(),
+            referrer=self._referrer,
+            request_environ=self._request_environ,
+            status_code=self.status_code,
+            status=self.status,
+            headers=self.headers,
+            response=self._response,
+            document=document,
+            parser_key=self._lxml_parser.cache_key)
+
+    def restore(self, snapshot):
+        """Return to the state captured by :meth:`snapshot`."""
+        self._cookie_jar = snapshot.cookie_jar.copy()
+        self._referrer = snapshot.referrer
+        self._request_environ = snapshot.request_environ
+        self.status_code = snapshot.status_code
+        self.status = snapshot.status
+        self.headers = snapshot.headers
+        self._response = snapshot.response
+        self._sync_document()
+        if snapshot.document is not None:
+            self._adopt_document(snapshot.document, snapshot.parser_key)
+
+    def fork(self):
+        """Return an independent browser continuing from the current page.
+
+        The fork shares nothing mutable with this browser: following links,
+        filling forms and receiving cookies in one does not affect the other.
+
+        """
+        fork = copy.copy(self)
+        for key in 'document', '_lxml_parser':
+            fork.__dict__.pop(key, None)
+        fork._cookie_jar = self._cookie_jar.copy()
+        fork.timing_history = TimingHistory()
+        fork.last_timings = None
+        if self.history is not None:
+            fork.history = self.history.copy()
+        document = self.__dict__.get('document')
+        if document is not None:
+            fork._adopt_document(document, self._lxml_parser.cache_key)
+        return fork
+
+    @property
+    def response(self):
+        """The body of the current page.
+
+        In :attr:`streaming` mode the body is spooled as it is read from the
+        application and only joined into a string on first access.
+
+        """
+        body = self._response
+        if isinstance(body, _SpooledBody):
+            self._response = body = body.getvalue()
+        return body
+
+    @response.setter
+    def response(self, value):
+        self._response = value
+
+    def _has_response(self):
+        # without joining a spooled body
+        return self._response is not None
+
+    def _response_chunks(self, size=65536):
+        body = self._response
+        if isinstance(body, _SpooledBody):
+            # read the spool without joining it into one string
+            return body.chunks(size)
+        return DOMMixin._response_chunks(self, size)
 
     @property
     def location(self):
@@ -113,15 +276,9 @@ class WSGI(DOMMixin):
     def cookies(self):
         if not (self._cookie_jar and self.location):
             return {}
-        request = urllib2.Request(self.location)
-        policy = self._cookie_jar._policy
-        policy._now = int(time())
-
-        # return ok will only return a cookie if the following attrs are set
-        # correctly => # "version", "verifiability", "secure", "expires",
-        # "port", "domain"
+        # only cookies that would be sent with a request for this page
         return dict((c.name, c.value.strip('"'))
-            for c in self._cookie_jar if policy.return_ok(c, request))
+            for c in self._cookie_jar.cookies_for_url(self.location))
 
     def set_cookie(self, name, value, domain=None, path=None,
                    session=True, expires=None, port=None, request=None):
@@ -154,73 +311,282 @@ class WSGI(DOMMixin):
     def _lxml_parser(self):
         return html_parser_for(self, wsgi_elements)
 
+    def _new_cookie_jar(self):
+        return CookieJar(threadsafe=self._wsgi_server['multithread'])
+
     def _open(self, url, method='GET', data=None, refer=True, content_type=None):
+        self.last_timings = timings = Timings(method, url)
         before_browser_activity.send(self)
-        open_started = time()
-        environ = self._create_environ(url, method, data, refer, content_type)
-        # keep a copy, the app may mutate the environ
-        request_environ = dict(environ)
-
-        logger.info('%s(%s) == %s', method, url, request_uri(environ))
-        request_started = time()
-        rv = run_wsgi_app(self._wsgi_app, environ)
-        response = BaseResponse(*rv)
-        # TODO:
-        # response.make_sequence()  # werkzeug 0.6+
-        # For now, must:
-        response.response = list(response.response)
-        if hasattr(rv[0], 'close'):
-            rv[0].close()
-        # end TODO
-
-        # request is complete after the app_iter (rv[0]) has been fully read +
-        # closed down.
-        request_ended = time()
-
-        self._request_environ = request_environ
-        self._cookie_jar.extract_from_werkzeug(response, environ)
-        self.status_code = response.status_code
-        # Automatically follow redirects
-        if 301 <= self.status_code <= 302:
-            logger.debug("Redirect to %s", response.headers['Location'])
-            after_browser_activity.send(self)
-            self._open(response.headers['Location'])
-            return
-        # redirects report the original referrer
-        self._referrer = request_uri(environ)
-        self.status = response.status
-        self.headers = response.headers
-        # TODO: unicodify
-        self.response = response.data
-        self._sync_document()
+        timings.mark('signals')
+        base_url = self._referrer if refer else self._base_url
+        referrer = self._referrer if refer else None
+        self.redirect_hops = hops = []
+        leaving = self.__dict__.get('document')
+
+        # Follow redirects and meta refreshes until a page is reached.
+        while True:
+            environ = self._create_environ(url, method, data, content_type,
+                                           base_url, referrer)
+            # keep a copy, the app may mutate the environ
+            request_environ = dict(environ)
+
+            logger.info('%s(%s) == %s', method, url, request_uri(environ))
+            cached = None
+            if self.http_cache is not None:
+                cached = self.http_cache.lookup(
+                    method, request_uri(environ), _environ_header(environ))
+            request_started = timings.mark('environ')
+            if cached is not None and cached.is_fresh():
+                logger.debug("Fresh in HTTP cache")
+                self.http_cache.hit(cached)
+                app_iter, status, headers = [cached.body], cached.status, \
+                                            cached.headers
+            else:
+                if cached is not None:
+                    for name, value in cached.conditional_headers():
+                        environ['HTTP_' + name.upper().replace('-', '_')] = \
+                            value
+                app_iter, status, headers = run_wsgi_app(self._wsgi_app,
+                                                         environ)
+                if cached is not None and status.startswith('304'):
+                    logger.debug("Not modified, served from HTTP cache")
+                    _drain(app_iter)
+                    headers = self.http_cache.revalidated(cached, headers)
+                    app_iter, status = [cached.body], cached.status
+                else:
+                    cached = None
+            timings.mark('app')
+            status_code = int(status.split(None, 1)[0])
+            redirect = (status_code in _redirect_codes and
+                        _has_header(headers, 'Location'))
+            if redirect:
+                # intermediate responses are never shown: don't keep them
+                response = BaseResponse((), status, headers)
+                _drain(app_iter)
+            elif self.streaming and cached is None:
+                response = BaseResponse((), status, headers)
+                body, document = self._drain_streaming(app_iter, timings)
+            else:
+                response = BaseResponse(app_iter, status, headers)
+                # TODO:
+                # response.make_sequence()  # werkzeug 0.6+
+                # For now, must:
+                response.response = list(response.response)
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                # end TODO
+
+            # request is complete after the app_iter has been fully read +
+            # closed down.
+            request_ended = timings.mark('drain')
+            if isinstance(environ.get('wsgi.input'), _MultipartStream):
+                # release an upload the app did not read to the end
+                environ['wsgi.input'].close()
+            hops.append((method, request_uri(environ), status_code,
+                         request_ended - request_started))
+
+            self._request_environ = request_environ
+            self._cookie_jar.extract_from_werkzeug(response, environ)
+            self.status_code = status_code
+            timings.mark('cookies')
+
+            if redirect:
+                if self.recorder is not None:
+                    self._record(request_environ, status, headers, '',
+                                 hops[-1][3])
+                location = response.headers['Location']
+                logger.debug("Redirect to %s", location)
+                if status_code in (307, 308) and method != 'GET':
+                    # the method and body are repeated at the new location
+                    pass
+                else:
+                    if status_code == 303 and method != 'HEAD':
+                        method = 'GET'
+                    elif status_code in (301, 302) and method == 'POST':
+                        # as browsers do, despite the RFC
+                        method = 'GET'
+                    # the Location, query and all, is requested as given
+                    data, content_type = None, None
+                # redirects report the original referrer
+                url, base_url = location, request_uri(environ)
+                self._check_redirect_limit(hops)
+                timings.mark('redirect')
+                continue
+
+            self._referrer = request_uri(environ)
+            self.status = response.status
+            self.headers = response.headers
+            self._sync_document()
+            if self.streaming and cached is None:
+                self.response = body
+                if document is not None:
+                    _bind_document(document, self)
+                    self.__dict__['document'] = document
+            else:
+                # TODO: unicodify
+                self.response = response.data
+            if self.http_cache is not None:
+                if cached is None:
+                    cached = self.http_cache.store(
+                        method, self._referrer, status, headers,
+                        self.response, _environ_header(request_environ))
+                self._page_document_cache = (
+                    cached is not None and self.http_cache.documents or None)
+            if self.recorder is not None:
+                self._record(request_environ, status, headers, self.response,
+                             hops[-1][3])
+            timings.mark('drain')
+
+            # TODO: what does a http-equiv redirect report for referrer?
+            refresh_url = self._meta_refresh_url()
+            timings.mark('redirect')
+            if refresh_url is None:
+                break
+            logger.debug("HTTP-EQUIV Redirect to %s", refresh_url)
+            url, method, data, content_type = refresh_url, 'GET', None, None
+            base_url = referrer = self._referrer
+            self._check_redirect_limit(hops)
+
+        if self.history is not None:
+            self.history.visit(HistoryEntry(
+                self._referrer, self._response,
+                request_environ=self._request_environ,
+                status_code=self.status_code,
+                status=self.status,
+                headers=self.headers), leaving)
+            timings.mark('history')
 
-        # TODO: what does a http-equiv redirect report for referrer?
-        if 'meta[http-equiv=refresh]' in self.document:
-            refresh = self.document['meta[http-equiv=refresh]'][0]
-            if 'content' in refresh.attrib:
-                parts = refresh.get('content').split(';url=', 1)
-                if len(parts) == 2:
-                    logger.debug("HTTP-EQUIV Redirect to %s", parts[1])
-                    after_browser_activity.send(self)
-                    self._open(parts[1])
-                    return
-
-        open_ended = time()
-        request_time = request_ended - request_started
         logger.info("Fetched %s in %0.3fsec + %0.3fsec browser overhead",
-                    url, request_time,
-                    open_ended - open_started - request_time)
+                    url, timings.application, timings.overhead)
         after_browser_activity.send(self)
+        timings.mark('signals')
+        self.timing_history.add(timings)
+
+    def _show_entry(self, entry):
+        """Show the page of a :class:`HistoryEntry`, or return False."""
+        if entry is None:
+            return False
+        self._referrer = entry.url
+        self._request_environ = entry.state['request_environ']
+        self.status_code = entry.state['status_code']
+        self.status = entry.state['status']
+        self.headers = entry.state['headers']
+        self.response = entry.body
+        self._page_document_cache = None
+        self._sync_document()
+        document = self.history.document(entry)
+        if document is not None:
+            _bind_document(document, self)
+            self.__dict__['document'] = document
+        return True
+
+    def _fetch_resource(self, url):
+        """GET *url* for the current page, without leaving it."""
+        environ = self._create_environ(url, 'GET', None, None, None,
+                                       self._referrer)
+        app_iter, status, headers = run_wsgi_app(self._wsgi_app, environ)
+        try:
+            body = ''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if not status.startswith('200'):
+            logger.debug("Resource %s: %s", url, status)
+            return None
+        return body
+
+    def _record(self, environ, status, headers, body, seconds):
+        """Log an exchange with :attr:`recorder`."""
+        # url-encoded bodies are in memory; multipart uploads are not kept
+        stream = environ.get('wsgi.input')
+        request_body = getattr(stream, 'getvalue', lambda: None)()
+        self.recorder.record(environ, status, list(headers), body,
+                             request_body, seconds)
+
+    def _meta_refresh_url(self):
+        """The target of a <meta http-equiv=refresh> in the page, or None."""
+        if 'document' not in self.__dict__:
+            # Don't parse the page just to find out there's no refresh.
+            body = self._response
+            if isinstance(body, _SpooledBody):
+                if not body.search(_meta_refresh_search):
+                    return None
+            elif not isinstance(body, basestring) or \
+                   not _meta_refresh_search(body):
+                return None
+        if self.document is None:
+            return None
+        for meta in self.document.iter('meta'):
+            if meta.get('http-equiv', '').strip().lower() != 'refresh':
+                continue
+            match = _refresh_url_match(meta.get('content', ''))
+            if match:
+                return match.group(1)
+            return None
+        return None
+
+    def _check_redirect_limit(self, hops):
+        if len(hops) > self.max_redirects:
+            raise RuntimeError(
+                "Exceeded %s redirects: %s" % (
+                    self.max_redirects,
+                    ' -> '.join(hop[1] for hop in hops)))
 
-    def _create_environ(self, url, method, data, refer, content_type=None):
+    def _adopt_document(self, document, parser_key):
+        """Install a copy of *document*, built by a parser with *parser_key*.
+        """
+        if parser_key == self._lxml_parser.cache_key:
+            document = copy.deepcopy(document)
+        else:
+            # built with other element classes: re-home the markup.
+            document = html_from_string(tostring(document),
+                                        parser=self._lxml_parser)
+        _bind_document(document, self)
+        self.__dict__['document'] = document
+
+    def _drain_streaming(self, app_iter, timings):
+        """Read *app_iter* into a spool, parsing HTML as it arrives.
+
+        Returns a (body, document) pair.  *document* is None if the body
+        does not look like a full HTML document, in which case it will be
+        parsed from :attr:`response` on demand.  Time spent feeding the
+        parser is charged to the 'parse' phase of *timings*.
+
+        """
+        body = _SpooledBody(self.spool_size)
+        parser, document = None, None
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+                if parser is None and not body.length:
+                    if self.parse_while_streaming and \
+                           _looks_like_full_html(chunk):
+                        parser = self._lxml_parser
+                body.write(chunk)
+                if parser is not None:
+                    timings.mark('drain')
+                    parser.feed(chunk)
+                    timings.mark('parse')
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if parser is not None:
+            timings.mark('drain')
+            document = parser.close()
+            timings.mark('parse')
+        return body, document
+
+    def _create_environ(self, url, method, data, content_type, base_url,
+                        referrer):
         """Return an environ to request *url*, including cookies."""
-        environ_args = dict(self._wsgi_server, method=method)
-        base_url = self._referrer if refer else self._base_url
-        environ_args.update(self._canonicalize_url(url, base_url))
+        environ_args = self._canonicalize_url(url, base_url)
         environ_args.update(self._prep_input(method, data, content_type))
-        environ = create_environ(**environ_args)
-        if refer and self._referrer:
-            environ['HTTP_REFERER'] = self._referrer
+        template = environ_template(environ_args.pop('base_url'),
+                                    **self._wsgi_server)
+        environ = template.environ(method=method, **environ_args)
+        if referrer:
+            environ['HTTP_REFERER'] = referrer
         environ.setdefault('REMOTE_ADDR', '127.0.0.1')
         self._cookie_jar.export_to_environ(environ)
         return environ
@@ -251,7 +617,13 @@ class WSGI(DOMMixin):
         return canonical
 
     def _prep_input(self, method, data, content_type):
-        """Return encoded and packed POST data."""
+        """Return encoded and packed POST data.
+
+        Data is sent as multipart/form-data if *content_type* asks for it or
+        a value is a ``(filename, mimetype)`` file upload.  File contents are
+        streamed from disk as the application reads them.
+
+        """
         if data is None or method != 'POST':
             prepped = {
                 'input_stream': None,
@@ -264,8 +636,17 @@ class WSGI(DOMMixin):
                     qs.setlistdefault(key).append(value)
                 prepped['query_string'] = url_encode(qs)
             return prepped
+        pairs = list(to_pairs(data))
+        if (content_type or '').startswith('multipart/form-data') or \
+               [value for name, value in pairs if isinstance(value, tuple)]:
+            stream = _MultipartStream(pairs)
+            return {
+                'input_stream': stream,
+                'content_length': stream.length,
+                'content_type': stream.content_type,
+                }
         else:
-            payload = url_encode(MultiDict(to_pairs(data)))
+            payload = url_encode(MultiDict(pairs))
             content_type = 'application/x-www-form-urlencoded'
             return {
                 'input_stream': StringIO(payload),
@@ -274,14 +655,275 @@ class WSGI(DOMMixin):
                 }
 
 
-def _wrap_file(filename, content_type):
-    """Open the file *filename* and wrap in a FileStorage object."""
-    assert os.path.isfile(filename), "File does not exist."
-    return FileStorage(
-        stream=open(filename, 'rb'),
-        filename=os.path.basename(filename),
-        content_type=content_type
-    )
+_redirect_codes = frozenset([301, 302, 303, 307, 308])
+
+
+def _environ_header(environ):
+    """A function returning request headers from *environ* by name."""
+    def header(name):
+        return environ.get('HTTP_' + name.upper().replace('-', '_'))
+    return header
+
+
+def _has_header(headers, name):
+    """True if a WSGI header list contains *name*."""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return True
+    return False
+
+
+def _drain(app_iter):
+    """Consume and close a WSGI application iterator."""
+    try:
+        for chunk in app_iter:
+            pass
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class _SpooledBody(object):
+    """A response body spooled to memory, then to disk past *max_size*."""
+
+    def __init__(self, max_size):
+        self.length = 0
+        self._spool = SpooledTemporaryFile(max_size=max_size)
+
+    def write(self, chunk):
+        self._spool.write(chunk)
+        self.length += len(chunk)
+
+    def getvalue(self):
+        """Return the body as a string."""
+        spool = self._spool
+        spool.seek(0)
+        return spool.read()
+
+    def chunks(self, size=65536):
+        """Yield the body in strings of at most *size* bytes."""
+        spool = self._spool
+        offset = 0
+        while offset < self.length:
+            spool.seek(offset)
+            chunk = spool.read(size)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def search(self, search, overlap=1024):
+        """Apply a regex *search* function to the body, chunk by chunk.
+
+        Chunks overlap by *overlap* bytes, so matches shorter than that are
+        found even where they straddle two chunks.
+
+        """
+        tail = ''
+        for chunk in self.chunks():
+            match = search(tail + chunk)
+            if match:
+                return match
+            tail = chunk[-overlap:]
+        return None
+
+
+class _MultipartStream(object):
+    """A multipart/form-data request body, read from disk on demand.
+
+    *pairs* are (name, value) form values; a ``(filename, mimetype)`` tuple
+    value uploads the named file.  The body is a sequence of segments, each
+    either a string (part headers and plain values) or a file, and files
+    are read in chunks only when the application reads that far, so an
+    upload costs no more memory than the application's read size.
+
+    """
+
+    def __init__(self, pairs):
+        self.boundary = '----AlfajorFormBoundary' + uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % (
+            self.boundary)
+        # (offset, length, string or filename, is file)
+        self._segments = segments = []
+        self.length = 0
+        for name, value in pairs:
+            if isinstance(value, tuple):
+                filename, mimetype = value
+                self._add(segments, self._part_header(
+                    name, os.path.basename(filename), mimetype))
+                self._add(segments, filename, os.path.getsize(filename))
+                self._add(segments, '\r\n')
+            else:
+                self._add(segments, self._part_header(name) +
+                          _encoded(value) + '\r\n')
+        self._add(segments, '--%s--\r\n' % self.boundary)
+        self._position = 0
+        self._file = self._file_name = None
+
+    def _add(self, segments, data, file_size=None):
+        """Append a string segment, or a file segment if *file_size*."""
+        if file_size is None:
+            segments.append((self.length, len(data), data, False))
+            self.length += len(data)
+        else:
+            segments.append((self.length, file_size, data, True))
+            self.length += file_size
+
+    def _part_header(self, name, filename=None, mimetype=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (
+            self.boundary, _quote_param(name))
+        if filename is not None:
+            header += '; filename="%s"\r\nContent-Type: %s' % (
+                _quote_param(filename), mimetype or 'application/octet-stream')
+        return header + '\r\n\r\n'
+
+    def read(self, size=-1):
+        remaining = self.length - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        chunks = []
+        while size > 0:
+            chunk = self._read_segment(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+            self._position += len(chunk)
+        if self._position >= self.length:
+            self.close()
+        return ''.join(chunks)
+
+    def _read_segment(self, size):
+        """Read up to *size* bytes of the segment at the current position."""
+        for offset, length, data, is_file in self._segments:
+            if offset <= self._position < offset + length:
+                break
+        skip = self._position - offset
+        size = min(size, length - skip)
+        if not is_file:
+            return data[skip:skip + size]
+        if self._file_name != data:
+            self.close()
+            self._file, self._file_name = open(data, 'rb'), data
+        self._file.seek(skip)
+        chunk = self._file.read(size)
+        if len(chunk) != size:
+            raise IOError("%s changed size during upload" % data)
+        return chunk
+
+    def readline(self, size=-1):
+        remaining = self.length - self._position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        line = []
+        while size > 0:
+            chunk = self._read_segment(min(size, 65536))
+            end = chunk.find('\n') + 1
+            if end:
+                chunk = chunk[:end]
+            line.append(chunk)
+            size -= len(chunk)
+            self._position += len(chunk)
+            if end:
+                break
+        if self._position >= self.length:
+            self.close()
+        return ''.join(line)
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._position
+        elif whence == 2:
+            offset += self.length
+        self._position = max(0, min(offset, self.length))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = self._file_name = None
+
+
+def _encoded(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _quote_param(value):
+    """Quote a multipart header parameter the way browsers do."""
+    return _encoded(value).replace('"', '%22').replace(
+        '\r', '%0D').replace('\n', '%0A')
+
+
+class _Snapshot(object):
+    """A captured WSGI browser state.  See :meth:`WSGI.snapshot`."""
+
+    def __init__(self, **state):
+        self.__dict__.update(state)
+
+
+class WSGIBrowserPool(object):
+    """Runs independent WSGI browser sessions concurrently.
+
+    Each session gets its own :class:`WSGI` browser, with its own cookie jar,
+    and runs on one of *size* worker threads sharing *wsgi_app*::
+
+      def checkout(browser, user):
+          browser.open('/login?user=%s' % user)
+          ...
+          return browser.status_code
+
+      pool = WSGIBrowserPool(app, 'http://localhost', size=8)
+      statuses = pool.map(checkout, users)
+
+    Additional keyword arguments are passed to each :class:`WSGI` browser.
+    Requests are made with ``wsgi.multithread`` set, as the application
+    will be entered from several threads at once.
+
+    """
+
+    def __init__(self, wsgi_app, base_url=None, size=4, **browser_options):
+        self.wsgi_app = wsgi_app
+        self.base_url = base_url
+        self.browser_options = browser_options
+        self._threads = ThreadPool(size)
+
+    def new_browser(self):
+        """Return a new browser session for use on a worker thread."""
+        return WSGI(self.wsgi_app, self.base_url, multithread=True,
+                    **self.browser_options)
+
+    def submit(self, flow, *args, **kw):
+        """Run *flow(browser, \*args, \*\*kw)* in a new browser session.
+
+        Returns a :class:`~alfajor.utilities.Future` for the flow's result.
+
+        """
+        return self._threads.submit(self._run, flow, args, kw)
+
+    def map(self, flow, *iterables):
+        """Run *flow* once per item of *iterables*, each in a new session.
+
+        Returns the flow results in order, re-raising the first failure.
+
+        """
+        futures = [self.submit(flow, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def close(self, wait=True):
+        """Shut down the worker threads after pending sessions complete."""
+        self._threads.close(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self, flow, args, kw):
+        return flow(self.new_browser(), *args, **kw)
 
 
 class FormElement(FormElement):
@@ -306,8 +948,8 @@ class FormElement(FormElement):
             action = urlparse(self.browser._referrer).path
         else:
             action = '/'
-        self.browser._open(action, method=method, data=values,
-                          content_type=self.get('enctype'))
+        return self.browser._open(action, method=method, data=values,
+                                  content_type=self.get('enctype'))
 
 
 class InputElement(InputElement):
@@ -321,19 +963,20 @@ class InputElement(InputElement):
     @value.setter
     def value(self, value):
         self.set('value', value)
+        _changed(self)
 
     @value.deleter
     def value(self):
         if 'value' in self.attrib:
             del self.attrib['value']
+            _changed(self)
 
     def click(self, wait_for=None, timeout=None):
         if self.checkable:
             self.checked = not self.checked
             return
         if self.type != 'submit':
-            super(InputElement, self).click(wait_for, timeout)
-            return
+            return super(InputElement, self).click(wait_for, timeout)
         for element in self.iterancestors():
             if element.tag == 'form':
                 break
@@ -344,7 +987,8 @@ class InputElement(InputElement):
         extra = ()
         if 'name' in self.attrib:
             extra = [[self.attrib['name'], self.attrib.get('value', 'Submit')]]
-        element.submit(wait_for=wait_for, timeout=timeout, _extra_values=extra)
+        return element.submit(wait_for=wait_for, timeout=timeout,
+                              _extra_values=extra)
 
 
 class ButtonElement(object):
@@ -374,7 +1018,7 @@ class LinkElement(object):
         except AttributeError:
             pass
         else:
-            self.browser._open(link, 'GET')
+            return self.browser._open(link, 'GET')
 
 
 wsgi_elements = {
@@ -388,88 +1032,277 @@ wsgi_elements = {
     }
 
 
-class CookieJar(cookielib.CookieJar):
-    """A lock-less CookieJar that can clone itself."""
-
-    def __init__(self, policy=None):
-        if policy is None:
-            policy = cookielib.DefaultCookiePolicy()
-        self._policy = policy
-        self._cookies = {}
-        self._cookies_lock = dummy_threading.RLock()
-
-    def export_to_environ(self, environ):
-        if len(self):
-            u_request = _WSGI_urllib2_request(environ)
-            self.add_cookie_header(u_request)
-
-    def extract_from_werkzeug(self, response, request_environ):
-        headers = response.headers
-        if 'Set-Cookie' in headers or 'Set-Cookie2' in headers:
-            u_response = _Werkzeug_urlib2_response(response)
-            u_request = _WSGI_urllib2_request(request_environ)
-            self.extract_cookies(u_response, u_request)
-
-
-class _Duck(object):
-    """Has arbitrary attributes assigned at construction time."""
-
-    def __init__(self, **kw):
-        for attr, value in kw.iteritems():
-            setattr(self, attr, value)
-
-
-class _Werkzeug_urlib2_response(object):
-    __slots__ = 'response',
-
-    def __init__(self, response):
-        self.response = response
-
-    def info(self):
-        return _Duck(getallmatchingheaders=self.response.headers.getlist,
-                     getheaders=self.response.headers.getlist)
-
-
-class _WSGI_urllib2_request(object):
+class CookieJar(object):
+    """A cookie jar indexed by domain and path, speaking WSGI natively.
 
-    def __init__(self, environ):
-        self.environ = environ
-        self.url = request_uri(self.environ)
-        self.url_parts = urlparse(self.url)
+    Cookies are :class:`cookielib.Cookie` records, stored under
+    ``domain -> path -> name`` as :mod:`cookielib` does.  ``Cookie`` headers
+    are written straight into the request environ and ``Set-Cookie``
+    headers are read straight from the response, without the urllib2
+    request and response shims :mod:`cookielib` needs.
 
-    def get_full_url(self):
-        return self.url
+    The jar can clone itself copy-on-write with :meth:`copy`, and is
+    lock-less unless *threadsafe*.
 
-    def get_host(self):
-        return self.url_parts.hostname
+    """
 
-    def get_type(self):
-        return self.url_parts.scheme
-
-    def is_unverifiable(self):
-        return False
+    def __init__(self, threadsafe=False):
+        self._cookies = {}
+        self._threadsafe = threadsafe
+        self._cookies_lock = self._new_lock()
+        self._shared = False
+
+    def _new_lock(self):
+        if self._threadsafe:
+            return threading.RLock()
+        return dummy_threading.RLock()
+
+    def copy(self):
+        """Return a copy-on-write clone of this jar."""
+        fork = copy.copy(self)
+        fork._cookies_lock = fork._new_lock()
+        fork._shared = self._shared = True
+        return fork
+
+    def _unshare(self):
+        # Cookie instances are replaced, never modified, so copying the
+        # domain -> path -> name index is enough.
+        self._cookies = dict(
+            (domain, dict((path, dict(names))
+                          for path, names in paths.iteritems()))
+            for domain, paths in self._cookies.iteritems())
+        self._shared = False
+
+    def __iter__(self):
+        self._cookies_lock.acquire()
+        try:
+            cookies = [cookie
+                       for paths in self._cookies.itervalues()
+                       for names in paths.itervalues()
+                       for cookie in names.itervalues()]
+        finally:
+            self._cookies_lock.release()
+        return iter(cookies)
+
+    def __len__(self):
+        return sum(len(names)
+                   for paths in self._cookies.itervalues()
+                   for names in paths.itervalues())
+
+    def set_cookie(self, cookie):
+        self._cookies_lock.acquire()
+        try:
+            if self._shared:
+                self._unshare()
+            paths = self._cookies.setdefault(cookie.domain, {})
+            paths.setdefault(cookie.path, {})[cookie.name] = cookie
+        finally:
+            self._cookies_lock.release()
 
-    def get_origin_req_host(self):
-        raise Exception('fixme need previous request')
+    def clear(self, domain=None, path=None, name=None):
+        """Remove cookies, as :meth:`cookielib.CookieJar.clear`.
 
-    def has_header(self, header):
-        key = header.replace('-', '_').upper()
-        return key in self.environ or 'HTTP_%s' % key in self.environ
+        Raises KeyError if there is no matching cookie.
 
-    def get_header(self, header):
-        return self.environ.get('HTTP_%s' % header.replace('-', '_').upper())
+        """
+        self._cookies_lock.acquire()
+        try:
+            if self._shared:
+                self._unshare()
+            if name is not None:
+                if domain is None or path is None:
+                    raise ValueError(
+                        "domain and path must be given to remove a cookie "
+                        "by name")
+                names = self._cookies[domain][path]
+                del names[name]
+                if not names:
+                    del self._cookies[domain][path]
+            elif path is not None:
+                if domain is None:
+                    raise ValueError(
+                        "domain must be given to remove cookies by path")
+                del self._cookies[domain][path]
+            elif domain is not None:
+                del self._cookies[domain]
+            else:
+                self._cookies = {}
+        finally:
+            self._cookies_lock.release()
+
+    def cookies_for(self, scheme, host, port, path):
+        """Cookies to send with a request, most specific path first."""
+        if not self._cookies:
+            return []
+        host = host.lower()
+        now = time()
+        found = []
+        self._cookies_lock.acquire()
+        try:
+            for domain, host_only_ok in _candidate_domains(host):
+                paths = self._cookies.get(domain)
+                if not paths:
+                    continue
+                for cookie_path, names in paths.iteritems():
+                    if not _path_matches(path, cookie_path):
+                        continue
+                    for cookie in names.itervalues():
+                        if not (host_only_ok or cookie.domain_specified):
+                            continue
+                        if cookie.secure and scheme != 'https':
+                            continue
+                        if cookie.expires is not None and \
+                               cookie.expires <= now:
+                            continue
+                        if cookie.port_specified and cookie.port and \
+                               port not in cookie.port.split(','):
+                            continue
+                        found.append(cookie)
+        finally:
+            self._cookies_lock.release()
+        found.sort(key=lambda cookie: len(cookie.path), reverse=True)
+        return found
+
+    def cookies_for_url(self, url):
+        """Cookies to send with a request for *url*."""
+        parts = urlparse(url)
+        port = parts.port or _default_ports.get(parts.scheme)
+        return self.cookies_for(parts.scheme, parts.hostname or '',
+                                str(port), parts.path or '/')
 
-    def header_items(self):
-        items = []
-        for key, value in self.environ.iteritems():
-            if ((key.startswith('HTTP_') or key.startswith('CONTENT_')) and
-                isinstance(value, basestring)):
-                if key.startswith('HTTP_'):
-                    key = key[5:]
-                key = key.replace('_', '-').title()
-                items.append((key, value))
-        return items
+    def export_to_environ(self, environ):
+        """Add a Cookie header for the request in *environ*."""
+        if not self._cookies:
+            return
+        host = environ.get('HTTP_HOST') or environ['SERVER_NAME']
+        path = (environ.get('SCRIPT_NAME', '') +
+                environ.get('PATH_INFO', '')) or '/'
+        cookies = self.cookies_for(environ['wsgi.url_scheme'],
+                                   host.split(':', 1)[0],
+                                   environ['SERVER_PORT'], path)
+        if cookies:
+            environ['HTTP_COOKIE'] = '; '.join(
+                cookie.value is None and cookie.name or
+                '%s=%s' % (cookie.name, cookie.value)
+                for cookie in cookies)
 
-    def add_unredirected_header(self, key, value):
-        if key == 'Cookie':
-            self.environ['HTTP_COOKIE'] = "%s: %s" % (key, value)
+    def extract_from_werkzeug(self, response, request_environ):
+        """Store the cookies set by *response* to *request_environ*."""
+        headers = response.headers
+        if 'Set-Cookie' not in headers:
+            return
+        host = request_environ.get('HTTP_HOST') or \
+               request_environ['SERVER_NAME']
+        host = host.split(':', 1)[0].lower()
+        path = (request_environ.get('SCRIPT_NAME', '') +
+                request_environ.get('PATH_INFO', '')) or '/'
+        now = time()
+        for header in headers.getlist('Set-Cookie'):
+            cookie = _parse_set_cookie(header, host, path, now)
+            if cookie is None:
+                continue
+            if cookie.expires is not None and cookie.expires <= now:
+                # an expiry in the past deletes the cookie
+                try:
+                    self.clear(cookie.domain, cookie.path, cookie.name)
+                except KeyError:
+                    pass
+            else:
+                self.set_cookie(cookie)
+
+
+_default_ports = {'http': 80, 'https': 443}
+
+
+def _candidate_domains(host):
+    """Yield (domain key, host-only cookies ok) pairs that may match *host*.
+    """
+    if not host:
+        yield '', True
+        return
+    yield host, True
+    yield '.' + host, False
+    if not _ip_address(host):
+        parts = host.split('.')
+        for i in xrange(1, len(parts)):
+            parent = '.'.join(parts[i:])
+            yield parent, False
+            yield '.' + parent, False
+    # cookies set through set_cookie() without a domain match any host
+    yield '', True
+
+
+_ip_address = re.compile(r'^[\d.]+$|:').search
+
+
+def _path_matches(request_path, cookie_path):
+    """Path-match as RFC 6265; an empty cookie path matches everything."""
+    if not cookie_path or request_path == cookie_path:
+        return True
+    return (request_path.startswith(cookie_path) and
+            (cookie_path.endswith('/') or
+             request_path[len(cookie_path)] == '/'))
+
+
+def _parse_set_cookie(header, host, request_path, now):
+    """A :class:`cookielib.Cookie` from a Set-Cookie *header*, or None.
+
+    Cookies with a Domain the request *host* does not belong to, or a
+    Domain without an embedded dot such as ``.com``, are rejected as
+    cookielib's :class:`~cookielib.DefaultCookiePolicy` does, as are
+    nameless cookies.
+
+    """
+    parts = header.split(';')
+    name, sep, value = parts[0].partition('=')
+    name = name.strip()
+    if not (sep and name):
+        return None
+    attrs = {}
+    for part in parts[1:]:
+        key, sep, attr_value = part.partition('=')
+        attrs[key.strip().lower()] = attr_value.strip()
+
+    domain = attrs.get('domain', '').lstrip('.').lower()
+    if domain:
+        if '.' not in domain and domain != 'local':
+            return None
+        # dotless hosts are matched as host.local
+        effective_host = '.' in host and host or host + '.local'
+        if effective_host != domain and \
+               not effective_host.endswith('.' + domain):
+            return None
+        domain = '.' + domain
+    else:
+        domain = host
+
+    path = attrs.get('path', '')
+    path_specified = path.startswith('/')
+    if not path_specified:
+        # the "directory" of the request path
+        path = request_path[:request_path.rfind('/')] or '/'
+
+    expires = None
+    if 'max-age' in attrs:
+        try:
+            expires = now + int(attrs['max-age'])
+        except ValueError:
+            pass
+    elif attrs.get('expires'):
+        expires = http2time(attrs['expires'])
+
+    try:
+        version = int(attrs.get('version', '0').strip('"'))
+    except ValueError:
+        version = 0
+
+    # Cookie(version, name, value, port, port_specified,
+    # domain, domain_specified, domain_initial_dot,
+    # path, path_specified, secure, expires,
+    # discard, comment, comment_url, rest,
+    # rfc2109=False):
+    return Cookie(version, name, value.strip(), None, False,
+                  domain, domain != host, domain.startswith('.'),
+                  path, path_specified, 'secure' in attrs, expires,
+                  expires is None, attrs.get('comment'), None,
+                  'httponly' in attrs and {'HttpOnly': None} or {})
@@ -0,0 +1,277 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'Alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Load generation from the flows written for functional tests.
+
+A flow is a function taking a browser (or API client) and driving it through
+a user journey::
+
+  def checkout(browser):
+      browser.open('/shop')
+      browser.document['a.buy'][0].click()
+      assert browser.status_code == 200
+
+  runner = LoadRunner(checkout, lambda: WSGI(app, 'http://localhost'),
+                      concurrency=20,
+                      patterns=[('/items/*', r'^/items/\d+')])
+  report = runner.run(duration=60)
+  print report
+
+Each run of a flow gets a new browser from the factory, so runs are
+independent sessions.  Every request a flow makes is timed from the
+``after_browser_activity`` signal (``after_api_request`` for APIClient)
+and the browser's ``last_timings``, and grouped by method and URL pattern
+in the :class:`LoadReport`.
+
+"""
+
+from itertools import cycle
+from logging import getLogger
+import re
+import threading
+from time import sleep, time
+from urlparse import urlsplit
+
+from blinker import signal
+
+from alfajor.browsers._timings import _percentile
+from alfajor.utilities import ThreadPool
+
+
+__all__ = ['LoadReport', 'LoadRunner', 'LoadStats']
+logger = getLogger('alfajor.load')
+after_api_request = signal('after_api_request')
+after_browser_activity = signal('after_browser_activity')
+
+
+class LoadRunner(object):
+    """Runs flows against fresh browsers and gathers request statistics.
+
+    :param flows: a flow, or a sequence of flows run in rotation.
+
+    :param browser_factory: a callable returning a new browser or client
+      for each run of a flow.  Any browser that sends the activity signals
+      and records ``last_timings`` works: WSGI, Network and APIClient
+      (which sends its own request signals).
+
+    :param concurrency: the number of flows run at once.
+
+    :param rate: if given, flows are started at this many per second
+      regardless of how long they take (up to *concurrency* at once),
+      rather than each of *concurrency* workers starting a new flow as soon
+      as its last one finishes.
+
+    :param patterns: (name, regex) pairs grouping request paths in the
+      report; the first match names the group.  Unmatched paths are
+      reported as they are.
+
+    """
+
+    def __init__(self, flows, browser_factory, concurrency=10, rate=None,
+                 patterns=()):
+        if callable(flows):
+            flows = [flows]
+        self.flows = list(flows)
+        self.browser_factory = browser_factory
+        self.concurrency = concurrency
+        self.rate = rate
+        self.patterns = [(name, re.compile(pattern))
+                         for name, pattern in patterns]
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def run(self, duration=None, iterations=None):
+        """Run flows for *duration* seconds or *iterations* runs.
+
+        Returns a :class:`LoadReport`.  At least one limit is required.
+
+        """
+        if duration is None and iterations is None:
+            raise ValueError("A duration or a number of iterations is "
+                             "required.")
+        self._report = report = LoadReport()
+        self._flows = cycle(self.flows)
+        self._remaining = iterations
+        self._deadline = duration is not None and time() + duration or None
+        after_browser_activity.connect(self._request_finished)
+        after_api_request.connect(self._request_finished)
+        pool = ThreadPool(self.concurrency)
+        try:
+            if self.rate:
+                self._arrivals(pool)
+            else:
+                for worker in xrange(self.concurrency):
+                    pool.submit(self._worker)
+        finally:
+            pool.close(wait=True)
+            after_browser_activity.disconnect(self._request_finished)
+            after_api_request.disconnect(self._request_finished)
+        report.elapsed = time() - report.started
+        return report
+
+    def _next_flow(self):
+        """The next flow to run, or None when the run is over."""
+        self._lock.acquire()
+        try:
+            if self._deadline is not None and time() >= self._deadline:
+                return None
+            if self._remaining is not None:
+                if self._remaining <= 0:
+                    return None
+                self._remaining -= 1
+            return self._flows.next()
+        finally:
+            self._lock.release()
+
+    def _worker(self):
+        """Run flows back to back until the run is over."""
+        while True:
+            flow = self._next_flow()
+            if flow is None:
+                break
+            self._run_flow(flow)
+
+    def _arrivals(self, pool):
+        """Start flows at :attr:`rate` per second."""
+        interval = 1.0 / self.rate
+        next_start = time()
+        while True:
+            flow = self._next_flow()
+            if flow is None:
+                break
+            pool.submit(self._run_flow, flow)
+            next_start += interval
+            delay = next_start - time()
+            if delay > 0:
+                sleep(delay)
+
+    def _run_flow(self, flow):
+        self._local.active = True
+        started = time()
+        try:
+            try:
+                flow(self.browser_factory())
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, exc:
+                logger.warning("Flow %s failed: %r", flow.__name__, exc)
+                failed = True
+            else:
+                failed = False
+        finally:
+            self._local.active = False
+        self._lock.acquire()
+        try:
+            self._report.flows.add(time() - started, failed)
+        finally:
+            self._lock.release()
+
+    def _request_finished(self, sender, **kw):
+        if not getattr(self._local, 'active', False):
+            # activity of a browser outside this run
+            return
+        timings = getattr(sender, 'last_timings', None)
+        if timings is None:
+            return
+        response = kw.get('response')
+        if response is not None:
+            status_code = response.status_code
+        else:
+            status_code = getattr(sender, 'status_code', 0)
+        key = '%s %s' % (timings.method, self._group(timings.url))
+        seconds = timings.total
+        self._lock.acquire()
+        try:
+            self._report.add(key, seconds, not 0 < status_code < 400)
+        finally:
+            self._lock.release()
+
+    def _group(self, url):
+        path = urlsplit(url).path or '/'
+        for name, pattern in self.patterns:
+            if pattern.search(path):
+                return name
+        return path
+
+
+class LoadStats(object):
+    """Latencies and failures of a set of requests or flows."""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._sorted = True
+
+    def add(self, seconds, failed=False):
+        self.latencies.append(seconds)
+        self._sorted = False
+        if failed:
+            self.errors += 1
+
+    @property
+    def count(self):
+        return len(self.latencies)
+
+    @property
+    def error_rate(self):
+        """The fraction of requests that failed."""
+        return self.count and float(self.errors) / self.count or 0.0
+
+    def percentile(self, percent):
+        """The *percent* percentile latency (nearest rank), or None."""
+        if not self._sorted:
+            self.latencies.sort()
+            self._sorted = True
+        return _percentile(self.latencies, percent)
+
+
+class LoadReport(object):
+    """The results of a :meth:`LoadRunner.run`.
+
+    :attr:`requests` maps 'METHOD pattern' to the :class:`LoadStats` of
+    those requests; :attr:`flows` holds the duration and failures of whole
+    flows.
+
+    """
+
+    percents = (50, 95, 99)
+
+    def __init__(self):
+        self.started = time()
+        self.elapsed = 0.0
+        self.requests = {}
+        self.flows = LoadStats()
+
+    def add(self, key, seconds, failed=False):
+        stats = self.requests.get(key)
+        if stats is None:
+            stats = self.requests[key] = LoadStats()
+        stats.add(seconds, failed)
+
+    @property
+    def request_count(self):
+        return sum(stats.count for stats in self.requests.itervalues())
+
+    @property
+    def throughput(self):
+        """Requests completed per second."""
+        return self.elapsed and self.request_count / self.elapsed or 0.0
+
+    def __str__(self):
+        lines = ['%d requests in %0.2fs (%0.1f/s), %d flows (%d failed)' % (
+            self.request_count, self.elapsed, self.throughput,
+            self.flows.count, self.flows.errors)]
+        header = ['%-40s %7s %7s' % ('request', 'count', 'errors')]
+        header.extend('%8s' % ('p%d' % percent) for percent in self.percents)
+        lines.append(' '.join(header))
+        for key in sorted(self.requests):
+            stats = self.requests[key]
+            row = ['%-40s %7d %6.1f%%' % (key[:40], stats.count,
+                                          stats.error_rate * 100)]
+            row.extend('%7.1fms' % (stats.percentile(percent) * 1000)
+                       for percent in self.percents)
+            lines.append(' '.join(row))
+        return '\n'.join(lines)
@@ -7,10 +7,13 @@
 """Utilities useful for managing functional browsers and HTTP clients."""
 
 import inspect
+import Queue
 import sys
+import threading
 import time
 
-__all__ = ['ServerSubProcess', 'eval_dotted_path', 'invoke']
+__all__ = ['Future', 'LRUCache', 'ServerSubProcess', 'ThreadPool',
+           'eval_dotted_path', 'invoke']
 
 
 def _import(module_name):
@@ -64,6 +67,218 @@ class lazy_property(object):
         return result
 
 
+class LRUCache(object):
+    """A bounded, thread-safe mapping that discards least recently used items.
+
+    Lookups through :meth:`get` are counted in :attr:`hits` and
+    :attr:`misses`.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all items and reset the hit and miss counters."""
+        self._lock.acquire()
+        try:
+            self._items = {}
+            # circular doubly linked list of [prev, next, key, value]
+            self._root = root = []
+            root[:] = [root, root, None, None]
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+    def get(self, key, default=None):
+        """Return the item for *key*, marking it as recently used."""
+        self._lock.acquire()
+        try:
+            link = self._items.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            prev, next = link[0], link[1]
+            prev[1], next[0] = next, prev
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = link
+            link[0], link[1] = last, root
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            items, root = self._items, self._root
+            link = items.pop(key, None)
+            if link is not None:
+                link[0][1], link[1][0] = link[1], link[0]
+            elif len(items) >= self.maxsize:
+                oldest = root[1]
+                oldest[0][1], oldest[1][0] = oldest[1], oldest[0]
+                del items[oldest[2]]
+            last = root[0]
+            last[1] = root[0] = items[key] = [last, root, key, value]
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """Remove *key* and return its item, or *default*."""
+        self._lock.acquire()
+        try:
+            link = self._items.pop(key, None)
+            if link is None:
+                return default
+            link[0][1], link[1][0] = link[1], link[0]
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '<%s %s/%s hits=%s misses=%s>' % (
+            type(self).__name__, len(self), self.maxsize,
+            self.hits, self.misses)
+
+
+class Future(object):
+    """The pending result of a call submitted to a :class:`ThreadPool`."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = self._exc_info = None
+
+    def done(self):
+        """True if the call has completed."""
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """Return the result of the call, re-raising any exception.
+
+        :param timeout: seconds to wait for the call to complete.  If the
+          call is not complete in time, RuntimeError is raised.
+
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the call, or None."""
+        self._wait(timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def _wait(self, timeout):
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise RuntimeError("Call did not complete in %ss." % timeout)
+
+    def add_done_callback(self, fn):
+        """Call *fn(future)* when the call completes (or now, if it has)."""
+        self._lock.acquire()
+        try:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._complete()
+
+    def set_exception(self, exc_info):
+        """Complete the call with *exc_info*, a sys.exc_info() triple."""
+        self._exc_info = exc_info
+        self._complete()
+
+    def _complete(self):
+        self._lock.acquire()
+        try:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+
+class ThreadPool(object):
+    """Runs calls on a fixed number of daemon worker threads."""
+
+    def __init__(self, size=4):
+        self.size = size
+        self._tasks = Queue.Queue()
+        self._threads = []
+        self._closed = False
+
+    def submit(self, fn, *args, **kw):
+        """Schedule *fn(\*args, \*\*kw)* and return its :class:`Future`."""
+        if self._closed:
+            raise RuntimeError("%s is closed." % type(self).__name__)
+        if len(self._threads) < self.size:
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        future = Future()
+        self._tasks.put((future, fn, args, kw))
+        return future
+
+    def map(self, fn, *iterables):
+        """Like :func:`map`, with calls run concurrently on the pool."""
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def close(self, wait=True):
+        """Stop accepting calls and stop the workers once the queue drains."""
+        if not self._closed:
+            self._closed = True
+            for thread in self._threads:
+                self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            future, fn, args, kw = task
+            try:
+                result = fn(*args, **kw)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            del task, future
+
+
 def to_pairs(dictlike):
     """Yield (key, value) pairs from any dict-like object.
 
@@ -4,6 +4,8 @@
 # This file is part of 'alfajor' and is distributed under the BSD license.
 # See LICENSE for more details.
 
+from alfajor.browsers._lxml import _document_state, shared_selector_cache
+
 from . import browser
 
 
@@ -20,6 +22,18 @@ def test_indexing():
     assert len(doc['#C']['li']) == 2
 
 
+def test_id_lookup():
+    browser.open('/dom')
+    doc = browser.document
+
+    assert doc.get_element_by_id('C') is doc['#C']
+    assert doc['#B']['#C'] is doc['#C']
+    assert doc['#C'].get_element_by_id('C') is doc['#C']
+    assert doc['#C'].get_element_by_id('A', None) is None
+    assert '#A' not in doc['#B']
+    assert doc.get_element_by_id('missing', None) is None
+
+
 def test_containment():
     browser.open('/dom')
     doc = browser.document
@@ -35,6 +49,31 @@ def test_containment():
     assert not 2 in doc
 
 
+def test_text_containment():
+    browser.open('/dom')
+
+    assert 'msg 1' in browser
+    assert 'msg\n  1' in browser
+    assert 'msg 1 msg' in browser
+    assert 'msg 5' not in browser
+    assert 'msg 5' not in browser
+
+    browser.open('/form/textareas')
+    assert 'typed' not in browser
+    browser.document['textarea'][0].value = 'typed  text'
+    assert 'typed text' in browser
+
+
+def test_subtree_text_containment():
+    browser.open('/dom')
+    first, second = browser.document['p'][:2]
+    state = _document_state(first)
+
+    assert state.contains(first, u'msg 1')
+    assert not state.contains(second, u'msg 1')
+    assert state.contains(browser.document, u'msg 1')
+
+
 def test_xpath():
     browser.open('/dom')
     doc = browser.document
@@ -43,6 +82,51 @@ def test_xpath():
     assert doc.xpath('/html/body/dl')[0] is doc['#A']
 
 
+def test_compiled_query_cache():
+    browser.open('/dom')
+    doc = browser.document
+
+    shared_selector_cache.clear()
+    first = doc['#A ul']
+    # results are remembered for the unchanged document
+    assert doc['#A ul'] == first
+    assert doc['#A ul'] is not first
+    assert '#A ul' in doc
+    assert (shared_selector_cache.hits, shared_selector_cache.misses) == (0, 1)
+
+    assert 'ul.marked' not in doc
+    doc['#C'].set('class', 'marked')
+    # changes made directly through lxml must be noted
+    assert 'ul.marked' not in doc
+    doc.mark_changed()
+    assert doc['ul.marked'] == first
+    assert doc['#A ul'] == first
+    assert (shared_selector_cache.hits, shared_selector_cache.misses) == (2, 2)
+
+    assert doc.xpath('//*[@id=$id]', id='A') == [doc['#A']]
+    assert doc.xpath('//*[@id=$id]', id='B') == [doc['#B']]
+    assert doc.xpath('count(//li)') == 2
+    assert len(shared_selector_cache) == 4
+
+
+def test_raw_changes_need_marking():
+    browser.open('/dom')
+    doc = browser.document
+    items = doc.cssselect('#C li')
+    assert len(items) == 2
+    assert doc.xpath('//li[text()="one"]') == []
+
+    doc['#C'].append(items[0].makeelement('li', {}))
+    items[0].text = 'one'
+    # raw lxml changes leave memoized results in place
+    assert len(doc.cssselect('#C li')) == 2
+    assert doc.xpath('//li[text()="one"]') == []
+
+    doc['#C'].mark_changed()
+    assert len(doc.cssselect('#C li')) == 3
+    assert doc.xpath('//li[text()="one"]') == [items[0]]
+
+
 def test_innerhtml():
     browser.open('/dom')
     ps = browser.document['p']
@@ -72,3 +156,26 @@ def test_visibility():
         assert not p.is_visible
     else:
         assert p.is_visible
+
+
+def test_computed_visibility():
+    if 'visibility' not in browser.capabilities:
+        return
+
+    browser.open('/visibility')
+    doc = browser.document
+
+    for id in 'plain', 'shown', 'unveiled', 'printed':
+        assert doc['#' + id].is_visible, id
+    for id in ('attribute', 'inline', 'linked', 'in-linked', 'veiled',
+               'in-veiled', 'note', 'screen', 'field'):
+        assert not doc['#' + id].is_visible, id
+    assert not doc['title'][0].is_visible
+
+    if 'in-process' not in browser.capabilities:
+        return
+    # styles follow changes made through lxml once they are marked
+    doc['#inline'].set('style', 'display: block')
+    assert not doc['#inline'].is_visible
+    doc['#inline'].mark_changed()
+    assert doc['#inline'].is_visible
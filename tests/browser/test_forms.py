@@ -29,6 +29,31 @@ def test_get():
         assert not post
 
 
+def test_inputs_by_name():
+    browser.open('/form/methods')
+    form = browser.document.forms[0]
+    assert form.inputs.keys() == ['first_name', 'email']
+    assert 'email' in form.inputs
+    assert 'missing' not in form.inputs
+    [email] = form.inputs['email']
+    email.value = 'tester@tester.com'
+    assert form.inputs['email'] == [email]
+    assert form.fields['email'] == 'tester@tester.com'
+    assert browser.document.forms[1].fields['email'] is None
+
+
+def test_form_values_follow_changes():
+    browser.open('/form/methods')
+    form = browser.document.forms[0]
+    values = form.form_values()
+    assert values == [('first_name', u''), ('email', u'')]
+    values.append(('extra', 'x'))
+    assert form.form_values() == [('first_name', u''), ('email', u'')]
+    form.fill({'email': 'tester@tester.com'})
+    assert form.form_values() == [('first_name', u''),
+                                  ('email', 'tester@tester.com')]
+
+
 def test_get_qs_append():
     browser.open('/form/methods?stuff=already&in=querystring')
     form = browser.document.forms[3]
@@ -0,0 +1,522 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+"""Tests specific to the in-process WSGI browser."""
+
+import os
+from tempfile import mkstemp
+
+from alfajor.browsers.asynchronous import AsyncWSGI, Return, SessionLoop
+from alfajor.browsers._history import History
+from alfajor.browsers._httpcache import HTTPCache
+from alfajor.browsers._lxml import DocumentCache
+from alfajor.browsers.managers import WSGIManager
+from alfajor.browsers.replay import Replay, TrafficLog, TrafficRecorder
+from alfajor.browsers.wsgi import (
+    CookieJar,
+    WSGI,
+    WSGIBrowserPool,
+    _MultipartStream,
+    )
+from alfajor._compat import json_loads as loads
+
+from nose.tools import assert_raises
+from werkzeug import BaseResponse, create_environ
+
+from .webapp import webapp
+
+
+base_url = 'http://localhost:8008'
+
+
+def test_streaming():
+    browser = WSGI(webapp(), base_url, streaming=True)
+    browser.open('/dom')
+    # the document is parsed while the response is read
+    assert 'document' in browser.__dict__
+    assert browser.document['#A'].tag == 'dl'
+    assert '<dl id="A">' in browser.response
+
+    buffered = WSGI(webapp(), base_url)
+    buffered.open('/dom')
+    assert browser.response == buffered.response
+    assert (browser.document.text_content ==
+            buffered.document.text_content)
+
+
+def test_streaming_follows_redirects():
+    browser = WSGI(webapp(), base_url, streaming=True)
+    browser.open('/seq/c')
+    assert browser.location.endswith('/seq/d')
+    assert browser.document['title'][0].text == 'seq/d'
+
+
+def test_stream_query():
+    browser = WSGI(webapp(), base_url, streaming=True)
+    browser.parse_while_streaming = False
+    browser.open('/dom')
+    assert 'document' not in browser.__dict__
+
+    matches = list(browser.stream_query(['#C li', 'dl#A > dd']))
+    assert 'document' not in browser.__dict__
+    # the spooled body was read in chunks, not joined
+    assert not isinstance(browser._response, basestring)
+    assert [source for source, element in matches].count('dl#A > dd') == \
+           len(browser.document.cssselect('dl#A > dd'))
+    expected = [element.text_content
+                for element in browser.document.cssselect('#C li')]
+    assert [element.text_content for source, element in matches
+            if source == '#C li'] == expected
+    assert matches[0][1].browser is browser
+
+    buffered = WSGI(webapp(), base_url)
+    buffered.open('/dom')
+    assert len(list(buffered.stream_query('li'))) == \
+           len(buffered.document.cssselect('li'))
+    assert_raises(ValueError, list, buffered.stream_query('li:first-child'))
+
+
+def test_document_cache():
+    cache = DocumentCache()
+    browser = WSGI(webapp(), base_url, document_cache=cache)
+    browser.open('/dom')
+    first = browser.document
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    first['#A'].set('class', 'mutated')
+    browser.open('/dom')
+    second = browser.document
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert second is not first
+    assert second['#A'].get('class') is None
+    assert second['#A'].browser is browser
+
+    # request ids differ, so this is a different document
+    browser.open('/seq/a')
+    browser.document
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_snapshot_restore():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/assign-cookie/1')
+    browser.open('/form/fill')
+    browser.document.forms[1].fill({'xx_a': 'snapshot'})
+    snapshot = browser.snapshot()
+
+    browser.delete_cookie('cookie1', 'localhost', '/')
+    browser.open('/dom')
+    assert not browser.cookies
+
+    for attempt in 1, 2:
+        browser.restore(snapshot)
+        assert browser.location.endswith('/form/fill')
+        assert browser.cookies == {'cookie1': 'value1'}
+        form = browser.document.forms[1]
+        assert form.fields['xx_a'] == 'snapshot'
+        form.fields['xx_a'] = 'changed'
+
+
+def test_fork():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/assign-cookie/1')
+    browser.open('/seq/a')
+    timings = browser.last_timings
+    recorded = len(browser.timing_history)
+    fork = browser.fork()
+    assert fork.last_timings is None
+    assert fork.location == browser.location
+    assert fork.cookies == browser.cookies
+    assert fork.document['#request_id'].text == \
+           browser.document['#request_id'].text
+
+    fork.document['a'][0].click()
+    assert fork.location.endswith('/seq/b')
+    assert browser.location.endswith('/seq/a')
+
+    fork.open('/assign-cookie/2')
+    assert 'cookie2' in fork.cookies
+    assert 'cookie2' not in browser.cookies
+
+    # request timings are the fork's own
+    assert fork.timing_history is not browser.timing_history
+    assert len(fork.timing_history) == 2
+    assert browser.last_timings is timings
+    assert len(browser.timing_history) == recorded
+
+
+def test_history():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/seq/a')
+    browser.open('/dom')
+    # history is only kept when asked for
+    assert browser.history is None and not browser.back()
+
+    browser = WSGI(webapp(), base_url, history=History())
+    assert not browser.back()
+    browser.open('/seq/a')
+    request_id = browser.document['#request_id'].text
+    browser.open('/form/fill')
+    browser.document.forms[1].fill({'xx_a': 'kept'})
+    browser.open('/dom')
+
+    # pages come back as they were left, without new requests
+    assert browser.back()
+    assert browser.location.endswith('/form/fill')
+    assert browser.document.forms[1].fields['xx_a'] == 'kept'
+    assert browser.back()
+    assert browser.location.endswith('/seq/a')
+    assert browser.document['#request_id'].text == request_id
+    assert not browser.back()
+    assert browser.forward() and browser.forward()
+    assert browser.location.endswith('/dom')
+    assert not browser.forward()
+
+    # visiting a page drops the pages ahead
+    browser.back()
+    browser.open('/seq/b')
+    assert not browser.forward()
+    assert len(browser.history) == 3
+
+    # a fork shares the left pages, but not the current one
+    fork = browser.fork()
+    assert fork.history.entries[0] is browser.history.entries[0]
+    assert fork.history.current is not browser.history.current
+    assert browser.history.current.size == 0
+    assert fork.back() and fork.location.endswith('/form/fill')
+    assert browser.location.endswith('/seq/b')
+
+    # past the budget, trees are parsed again and old pages forgotten
+    browser.history = History(max_bytes=700, max_documents=0)
+    for page in '/seq/a', '/dom', '/form/fill':
+        browser.open(page)
+    browser.document.forms[1].fill({'xx_a': 'lost'})
+    browser.open('/dom')
+    browser.back()
+    assert browser.document.forms[1].fields['xx_a'] != 'lost'
+    assert browser.history.size <= 700
+    assert len(browser.history) < 4
+
+
+def test_shared_element_classes():
+    app = webapp()
+    first, second = WSGI(app, base_url), WSGI(app, base_url)
+    first.open('/seq/a')
+    second.open('/seq/a')
+    link = first.document['a'][0]
+    assert type(link) is type(second.document['a'][0])
+    assert link.browser is first
+    assert second.document['a'][0].browser is second
+
+    fork = first.fork()
+    assert fork.document['a'][0].browser is fork
+    # elements outlive their document's root and still find the browser
+    first.open('/dom')
+    assert link.browser is first
+
+
+def test_browser_pool():
+    def flow(browser, number):
+        if number % 2:
+            browser.open('/assign-cookie/1')
+        browser.open('/seq/a')
+        return (browser._request_environ['wsgi.multithread'],
+                sorted(browser.cookies))
+
+    pool = WSGIBrowserPool(webapp(), base_url, size=4)
+    try:
+        results = pool.map(flow, range(20))
+    finally:
+        pool.close()
+    for number, (multithread, cookies) in enumerate(results):
+        assert multithread
+        assert cookies == (['cookie1'] if number % 2 else [])
+
+
+def test_redirect_methods():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/form/methods')
+    form = browser.document.forms[4]
+    for code, method in (301, 'GET'), (302, 'GET'), (303, 'GET'), \
+                        (307, 'POST'), (308, 'POST'):
+        form.set('action', '/redirect/%s?to=/form/methods' % code)
+        form.fill({'email': 'x@example.com'})
+        form.submit()
+        assert browser.status_code == 200
+        assert browser.location.endswith('/form/methods')
+        posted = loads(browser.document['#post_data'].text)
+        assert bool(posted) == (method == 'POST'), code
+        assert [hop[:3] for hop in browser.redirect_hops] == [
+            ('POST', 'http://localhost:8008/redirect/%s?to=/form/methods' %
+             code, code),
+            (method, 'http://localhost:8008/form/methods', 200)]
+        form = browser.document.forms[4]
+
+
+def test_redirect_get_form():
+    browser = WSGI(webapp(), base_url)
+    for code in 301, 302, 303, 307, 308:
+        browser.open('/form/methods')
+        form = browser.document.forms[6]
+        form.set('action', '/redirect/%s' % code)
+        form.fill({'email': 'x@example.com'})
+        form.submit()
+        assert browser.status_code == 200, code
+        assert browser.location.endswith('/form/methods?id=5'), code
+        assert loads(browser.document['#get_data'].text) == [['id', '5']]
+
+
+def test_redirect_limit():
+    browser = WSGI(webapp(), base_url, max_redirects=3)
+    browser.open('/redirect/302?to=/redirect/307?to=/seq/d')
+    assert browser.location.endswith('/seq/d')
+    assert len(browser.redirect_hops) == 3
+
+    assert_raises(RuntimeError, browser.open, '/redirect/302')
+
+
+def test_lazy_document():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/dom')
+    assert browser.status_code == 200
+    assert 'document' not in browser.__dict__
+    assert browser.document['#A'].tag == 'dl'
+
+
+def test_meta_refresh():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/refresh')
+    assert browser.location.endswith('/seq/d')
+    assert '/refresh' in browser.document['p.referrer'][0].text
+    assert [hop[1] for hop in browser.redirect_hops] == \
+           [base_url + '/refresh', base_url + '/seq/d']
+
+
+def test_timings():
+    browser = WSGI(webapp(), base_url)
+    browser.open('/seq/c')
+    timings = browser.last_timings
+    assert timings.method == 'GET' and timings.url == '/seq/c'
+    for phase in 'environ', 'app', 'drain', 'cookies', 'redirect', 'signals':
+        assert phase in timings.phases, phase
+    assert 'parse' not in timings.phases
+    assert abs(timings.total - timings.application - timings.overhead) < 1e-9
+
+    browser.document
+    assert 'parse' in timings.phases
+
+    browser.open('/dom')
+    history = browser.timing_history
+    assert len(history) == 2
+    assert list(history)[-1] is browser.last_timings
+    assert history.percentile('total', 50) <= history.percentile('total', 100)
+    assert history.summary()['parse'][-1] == timings['parse']
+
+
+def test_cookie_jar():
+    jar = CookieJar()
+    response = BaseResponse()
+    response.set_cookie('host', 'h')
+    response.set_cookie('wide', 'w', domain='.example.com', path='/app')
+    response.set_cookie('private', 'p', secure=True)
+    response.set_cookie('evil', 'e', domain='.other.com')
+    response.headers.add('Set-Cookie', 'tld=t; Domain=com')
+    response.set_cookie('dotted_tld', 't', domain='.com')
+    jar.extract_from_werkzeug(
+        response, create_environ('/app/page', 'http://www.example.com/'))
+    assert len(jar) == 3
+
+    def sent(url):
+        environ = create_environ(base_url=url)
+        jar.export_to_environ(environ)
+        return environ.get('HTTP_COOKIE')
+
+    assert sent('http://www.example.com/app/x') == 'wide=w; host=h'
+    assert sorted(sent('https://www.example.com/').split('; ')) == \
+           ['host=h', 'private=p']
+    assert sent('http://sub.example.com/app') == 'wide=w'
+    assert sent('http://sub.example.com/application') is None
+    assert sent('http://example.org/') is None
+
+    response = BaseResponse()
+    response.delete_cookie('host')
+    jar.extract_from_werkzeug(
+        response, create_environ('/', 'http://www.example.com/'))
+    assert sent('http://www.example.com/') is None
+    assert [cookie.name for cookie in jar.cookies_for_url(
+        'http://www.example.com/app/')] == ['wide']
+
+
+def test_http_cache():
+    cache = HTTPCache()
+    browser = WSGI(webapp(), base_url, http_cache=cache)
+
+    def request_id(url):
+        browser.open(url)
+        assert browser.status_code == 200
+        return browser.document['#request_id'].text
+
+    fresh = request_id('/cached?max_age=60')
+    assert request_id('/cached?max_age=60') == fresh
+    assert (cache.hits, cache.documents.hits) == (1, 1)
+
+    validated = request_id('/cached?etag=x')
+    assert request_id('/cached?etag=x') == validated
+    assert cache.revalidations == 1
+    assert browser.headers['ETag'] == 'x'
+    assert request_id('/cached') != request_id('/cached')
+    assert len(cache) == 2
+
+    # unsafe methods invalidate the cached page
+    browser._open('/cached?max_age=60', method='POST', data={'a': 1})
+    assert request_id('/cached?max_age=60') != fresh
+
+
+def test_record_and_replay():
+    fd, filename = mkstemp()
+    os.close(fd)
+    try:
+        recorder = TrafficRecorder(filename)
+        browser = WSGI(webapp(), base_url, recorder=recorder)
+        browser.open('/dom')
+        browser.open('/dom')
+        browser.open('/assign-cookie/1?bounce=/cached')
+        request_id = browser.document['#request_id'].text
+        browser._open('/cached', method='POST', data={'a': 1})
+        recorder.close()
+
+        log = TrafficLog(filename)
+        assert [(exchange.method, exchange.status[:3]) for exchange in log] \
+               == [('GET', '200'), ('GET', '200'), ('GET', '301'),
+                   ('GET', '200'), ('POST', '200')]
+        assert log.exchanges[0].body is log.exchanges[1].body
+        assert log.exchanges[4].request_body == 'a=1'
+        assert 'wsgi.input' not in log.exchanges[0].environ
+        # bodies are stored once: /dom, the redirect, two /cached and 'a=1'
+        records = [loads(line) for line in open(filename)]
+        assert len([record for record in records
+                    if record['type'] == 'body']) == 5
+
+        replay = Replay(filename, base_url)
+        replay.open('/assign-cookie/1?bounce=/cached')
+        assert replay.location.endswith('/cached')
+        assert replay.document['#request_id'].text == request_id
+        assert replay.cookies == {'cookie1': 'value1'}
+        replay.open('/dom')
+        assert replay.document['#A'].tag == 'dl'
+        replay.open('/not/recorded')
+        assert replay.status_code == 404
+    finally:
+        os.unlink(filename)
+
+
+def test_manager_recorder():
+    fd, filename = mkstemp()
+    os.close(fd)
+    try:
+        manager = WSGIManager('wsgi', {
+            'server-entry-point': 'tests.browser.webapp:webapp()',
+            'base_url': base_url,
+            'record-traffic': filename}, {})
+        first, second = manager.create(), manager.create()
+        recorder = manager.recorder
+        assert first.recorder is second.recorder is recorder
+        manager.destroy()
+        assert recorder._log.closed
+        assert manager.recorder is None
+        assert manager.create().recorder is not recorder
+        manager.destroy()
+    finally:
+        os.unlink(filename)
+
+
+def test_multipart_upload():
+    fd, filename = mkstemp()
+    upload = os.fdopen(fd, 'wb')
+    try:
+        for block in xrange(64):
+            upload.write(chr(block) * 16384 + '\r\n--')
+        upload.close()
+
+        browser = WSGI(webapp(), base_url)
+        browser.open('/form/multipart')
+        form = browser.document.forms[1]
+        form['input[name=search]'][0].value = u'caf\xe9'
+        form['input[name=file]'][0].value = filename
+        form.submit()
+
+        assert 'boundary=' in browser._request_environ['CONTENT_TYPE']
+        assert browser._request_environ['wsgi.input'].tell() == \
+               int(browser._request_environ['CONTENT_LENGTH'])
+        data = loads(browser.document['#data'].text)
+        assert data == [['search', u'caf\xe9']]
+        [(name, (basename, mimetype, length, saved))] = \
+            loads(browser.document['#files'].text)
+        try:
+            assert name == 'file'
+            assert basename == os.path.basename(filename)
+            assert open(saved, 'rb').read() == open(filename, 'rb').read()
+        finally:
+            os.unlink(saved)
+    finally:
+        os.unlink(filename)
+
+
+def test_multipart_stream_lines():
+    fd, filename = mkstemp()
+    upload = os.fdopen(fd, 'wb')
+    try:
+        upload.write('a' * 100000 + '\nb\n')
+        upload.close()
+
+        stream = _MultipartStream([('file', (filename, 'text/plain'))])
+        lines = list(iter(stream.readline, ''))
+        assert stream.tell() == stream.length
+        assert [line for line in lines if not line.endswith('\n')] == []
+        assert 'a' * 100000 + '\n' in lines
+        assert 'b\n' in lines
+        assert stream._file is None
+        assert stream.readline() == ''
+
+        stream.seek(0)
+        assert stream.read(10) == lines[0][:10]
+        assert stream.read() == ''.join(lines)[10:]
+        assert stream._file is None
+    finally:
+        os.unlink(filename)
+
+
+def test_async_sessions():
+    loop = SessionLoop(size=2)
+    app = webapp()
+
+    def follow(browser):
+        yield browser.open('/seq/a')
+        yield browser.document['a'][0].click()
+        raise Return(browser.location)
+
+    def session(number):
+        browser = AsyncWSGI(loop, app, base_url)
+        if number % 2:
+            yield browser.open('/assign-cookie/1')
+        location = yield follow(browser)
+        assert location.endswith('/seq/b')
+        yield browser.wait_for('duration', 1)
+        raise Return(sorted(browser.cookies))
+
+    def failing():
+        browser = AsyncWSGI(loop, app)
+        yield browser.open('/seq/a')
+
+    try:
+        sessions = [loop.spawn(session, number) for number in range(20)]
+        failure = loop.spawn(failing)
+        loop.run()
+    finally:
+        loop.close()
+    for number, future in enumerate(sessions):
+        assert future.result() == (['cookie1'] if number % 2 else [])
+    assert isinstance(failure.exception(), RuntimeError)
@@ -26,6 +26,8 @@ class WebApp(object):
         Rule('/', endpoint='index'),
         Rule('/assign-cookie/1', endpoint='assign_cookie'),
         Rule('/assign-cookie/2', endpoint='assign_cookies'),
+        Rule('/redirect/<int:code>', endpoint='redirect'),
+        Rule('/cached', endpoint='cached'),
         ])
 
     def __call__(self, environ, start_response):
@@ -92,6 +94,23 @@ class WebApp(object):
         rsp.location = request.host_url.rstrip('/') + '/seq/d'
         return rsp
 
+    def redirect(self, request):
+        rsp = Response('', status=request.environ['routing_args']['code'])
+        rsp.location = request.args.get('to', request.url)
+        return rsp
+
+    def cached(self, request):
+        etag = request.args.get('etag')
+        if etag and request.headers.get('If-None-Match') == etag:
+            rsp = Response(status=304)
+        else:
+            rsp = self.generic_template_renderer(request)
+        if etag:
+            rsp.headers['ETag'] = etag
+        if 'max_age' in request.args:
+            rsp.headers['Cache-Control'] = 'max-age=' + request.args['max_age']
+        return rsp
+
     def assign_cookie(self, request):
         rsp = self.generic_template_renderer(request)
         rsp.set_cookie('cookie1', 'value1', path='/')
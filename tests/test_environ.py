@@ -0,0 +1,50 @@
+from cStringIO import StringIO
+
+from werkzeug import create_environ as werkzeug_create_environ
+
+from alfajor._environ import create_environ, environ_template
+
+
+def _comparable(environ):
+    environ = dict(environ)
+    stream = environ.pop('wsgi.input')
+    environ['wsgi.input'] = stream.read()
+    stream.seek(0)
+    return environ
+
+
+def test_matches_werkzeug():
+    cases = [
+        (),
+        ('/',),
+        ('/a%20b/c?x=1&y=2',),
+        (u'/caf\xe9', 'http://localhost:8008'),
+        ('/p', 'https://example.com/mount/', 'q=1', 'HEAD'),
+        ('/p', 'http://example.com:8080', [('a', '1'), ('a', '2')]),
+        ('/p', 'http://example.com', None, 'POST', StringIO('a=1'),
+         'application/x-www-form-urlencoded', 3),
+        ('/p', 'http://example.com', None, 'PUT', StringIO('{}'),
+         'application/json'),
+        ('/p', None, None, 'GET', None, None, 0, None, True, False, True),
+        ]
+    for args in cases:
+        expected = _comparable(werkzeug_create_environ(*args))
+        assert _comparable(create_environ(*args)) == expected, args
+
+    # werkzeug makes up a body (and a random boundary) for empty forms
+    environ = create_environ('/p', None, None, 'POST', None,
+                             'multipart/form-data')
+    assert environ['CONTENT_TYPE'].startswith('multipart/form-data; boundary')
+
+
+def test_templates_are_shared():
+    template = environ_template('http://localhost:8008')
+    assert environ_template('http://localhost:8008') is template
+    assert environ_template('http://localhost:8008', True) is not template
+
+    first = template.environ('/a')
+    first['PATH_INFO'] = '/changed'
+    first['HTTP_COOKIE'] = 'a=1'
+    second = template.environ('/b')
+    assert second['PATH_INFO'] == '/b'
+    assert 'HTTP_COOKIE' not in second
@@ -0,0 +1,70 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+from alfajor.apiclient import APIClient
+from alfajor.browsers.wsgi import WSGI, after_browser_activity
+from alfajor.load import LoadRunner
+
+from nose.tools import assert_raises
+
+from tests.browser.webapp import webapp
+
+
+base_url = 'http://localhost:8008'
+app = webapp()
+
+
+def follow(browser):
+    browser.open('/seq/a')
+    browser.document['a'][0].click()
+    assert browser.location.endswith('/seq/b')
+
+
+def broken(browser):
+    browser.open('/assign-cookie/1')
+    raise AssertionError("failed")
+
+
+def test_concurrency():
+    runner = LoadRunner([follow, broken], lambda: WSGI(app, base_url),
+                        concurrency=3, patterns=[('/seq/*', '^/seq/')])
+    report = runner.run(iterations=10)
+    assert (report.flows.count, report.flows.errors) == (10, 5)
+    assert sorted(report.requests) == ['GET /assign-cookie/1', 'GET /seq/*']
+    stats = report.requests['GET /seq/*']
+    assert (stats.count, stats.errors) == (10, 0)
+    assert 0 < stats.percentile(50) <= stats.percentile(99)
+    assert report.request_count == 15
+    assert report.throughput > 0
+    assert 'GET /seq/*' in str(report)
+
+    # activity outside a run is not counted
+    WSGI(app, base_url).open('/seq/a')
+    assert report.request_count == 15
+    assert_raises(ValueError, runner.run)
+
+
+def test_arrival_rate_api_client():
+    def missing(client):
+        assert client.get('/missing').status_code == 404
+
+    browser_senders = []
+
+    def browser_activity(sender, **kw):
+        browser_senders.append(sender)
+
+    runner = LoadRunner(missing, lambda: APIClient(app, base_url=base_url),
+                        rate=200)
+    after_browser_activity.connect(browser_activity)
+    try:
+        report = runner.run(iterations=4, duration=10)
+    finally:
+        after_browser_activity.disconnect(browser_activity)
+    # the client has signals of its own
+    assert browser_senders == []
+    assert report.requests['GET /missing'].count == 4
+    assert report.requests['GET /missing'].error_rate == 1.0
+    assert report.flows.errors == 0
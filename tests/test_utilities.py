@@ -0,0 +1,53 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+from alfajor.utilities import LRUCache, ThreadPool
+
+from nose.tools import assert_raises
+
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    # 'b' was least recently used
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    cache['a'] = 10
+    cache['d'] = 4
+    assert 'c' not in cache
+    assert cache.get('a') == 10
+
+    cache.clear()
+    assert not len(cache)
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_thread_pool():
+    pool = ThreadPool(3)
+    try:
+        assert pool.map(lambda x, y: x * y, range(10), range(10)) == \
+               [x * x for x in range(10)]
+
+        future = pool.submit(int, 'not a number')
+        assert_raises(ValueError, future.result)
+        assert isinstance(future.exception(), ValueError)
+
+        seen = []
+        future = pool.submit(len, 'abc')
+        assert future.result(timeout=5) == 3
+        future.add_done_callback(seen.append)
+        assert seen == [future]
+    finally:
+        pool.close()
+    assert_raises(RuntimeError, pool.submit, len, 'abc')
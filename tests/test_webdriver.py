@@ -0,0 +1,109 @@
+# Copyright Action Without Borders, Inc., the Alfajor authors and contributors.
+# All rights reserved.  See AUTHORS.
+#
+# This file is part of 'alfajor' and is distributed under the BSD license.
+# See LICENSE for more details.
+
+from alfajor.browsers._lxml import _document_state
+from alfajor.browsers.webdriver import (
+    StaleElementReference,
+    WebDriver,
+    WebDriverRemote,
+    )
+
+from nose.tools import assert_raises
+
+
+page = '''<html><body><form>
+<input type="text" name="a" id="a"><input type="text" name="b">
+</form></body></html>'''
+
+
+class RecordingRemote(WebDriverRemote):
+    """Answers WebDriver commands for a static page, logging them."""
+
+    def __init__(self):
+        WebDriverRemote.__init__(self, 'http://localhost:4444')
+        self.commands = []
+        self.stale = set()
+        self.lookups = 0
+
+    def __call__(self, method, command='', **kw):
+        self.commands.append((method, command))
+        if command == 'source':
+            return {'value': page}
+        if command == 'execute':
+            # visible unless located by xpath
+            return {'value': [using != 'xpath' or None
+                              for using, value in kw['args'][0]]}
+        if command == 'element':
+            self.lookups += 1
+            return {'value': {'ELEMENT': '%s-%s' % (kw['value'],
+                                                    self.lookups)}}
+        if command.split('/')[1] in self.stale:
+            self.stale.clear()
+            raise StaleElementReference()
+        return {'value': u''}
+
+
+def browser_with_remote():
+    browser = WebDriver('http://localhost:4444')
+    browser.webdriver = RecordingRemote()
+    browser.sync_document()
+    return browser
+
+
+def test_element_ids_are_cached():
+    browser = browser_with_remote()
+    remote = browser.webdriver
+    field = browser.document['#a']
+    field.value = 'x'
+    field.value
+    assert remote.lookups == 1
+    assert len(remote.commands) == 5
+
+    browser.sync_document()
+    field.value
+    assert remote.lookups == 2
+
+
+def test_sync_document_marks_old_document_changed():
+    browser = browser_with_remote()
+    old = browser.document
+    state = _document_state(old)
+    assert state.memoized('probe', lambda: 'old') == 'old'
+
+    browser.sync_document()
+    assert browser.document is not old
+    # lookups through elements of the old document are not memoized
+    assert state.memoized('probe', lambda: 'new') == 'new'
+
+
+def test_stale_element_ids():
+    browser = browser_with_remote()
+    remote = browser.webdriver
+    field = browser.document['#a']
+    field.value
+    remote.stale.add(field.wd_id())
+    assert field.value == u''
+    assert remote.lookups == 2
+
+    # an id fresh from a lookup is not retried
+    browser.sync_document()
+    remote.stale.add('a-3')
+    assert_raises(StaleElementReference, browser.document['#a']._command,
+                  'GET', 'value')
+
+
+def test_visibility_in_one_request():
+    browser = browser_with_remote()
+    remote = browser.webdriver
+    commands = len(remote.commands)
+    named, unnamed = browser.document['input']
+    assert named.is_visible
+    assert browser.visibility([named, unnamed]) == [True, False]
+    assert remote.commands[commands:] == [('POST', 'execute')] * 2
+    assert remote.lookups == 0
+
+    assert browser.wait_for('visible:css=#a', timeout=0)
+    assert browser.wait_for('!visible://input[2]', timeout=0)